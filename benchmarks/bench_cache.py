@@ -0,0 +1,37 @@
+import os
+import random
+import tempfile
+
+from typing import Dict
+
+from benchmarks.common import per_call
+from src import cache
+
+
+def _payload(i: int) -> Dict:
+    return {
+        "size": "100",
+        "address": {"code": 90000 + i % 1000, "city": "Łódź", "street": f"ULICA {i // 1000}", "buildingNumber": i % 200},
+        "nearestPOI": "D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY"
+    }
+
+
+def run(sizes=(1000, 10000, 100000), lookups: int = 2000) -> Dict:
+    endpoint = "bik-api-4/punkty-zainteresowania-adres"
+    response = {"nearestPOI": {"D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY": 123.4}}
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            c = cache.Cache(os.path.join(tmp, f"{size}.sqlite"), l1_size=lookups, max_bytes=2**40)
+            c.l2.put_many((cache.key(endpoint, _payload(i)), endpoint, _payload(i), response) for i in range(size))
+            keys = [_payload(random.randrange(size)) for _ in range(lookups)]
+            it = iter(keys)
+            l2 = per_call(lambda: c.l2.get(cache.key(endpoint, next(it))), lookups)
+            for payload in keys:
+                c.get(endpoint, payload)
+            it = iter(keys)
+            l1 = per_call(lambda: c.get(endpoint, next(it)), lookups)
+            it = iter(keys)
+            miss = per_call(lambda: c.get(endpoint, dict(next(it), size="missing")), lookups)
+            results[size] = dict(l1_seconds=l1, l2_seconds=l2, miss_seconds=miss, **c.l2.stats())
+    return results
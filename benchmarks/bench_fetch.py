@@ -0,0 +1,37 @@
+import time
+
+from typing import Dict
+
+from benchmarks.common import addresses, summarize, timed
+
+
+def run(n_addresses: int = 20) -> Dict:
+    # src.req reads the gateway and cache settings on first use
+    from src import req
+
+    cold, warm_l2, warm_l1 = [], [], []
+    for address in addresses(n_addresses, street="BENCHMARKOWA"):
+        start = time.perf_counter()
+        req.criterions(**address)
+        cold.append(time.perf_counter() - start)
+
+    req._get_cache().l1.clear()
+    for address in addresses(n_addresses, street="BENCHMARKOWA"):
+        start = time.perf_counter()
+        req.criterions(**address)
+        warm_l2.append(time.perf_counter() - start)
+
+    for address in addresses(n_addresses, street="BENCHMARKOWA"):
+        start = time.perf_counter()
+        req.criterions(**address)
+        warm_l1.append(time.perf_counter() - start)
+
+    # a cold plan for many addresses at once, shared calls fetched once
+    batch = addresses(n_addresses, street="BENCHMARKOWA-BATCH")
+    return dict(
+        criterions_cold=summarize(cold),
+        criterions_warm_l2=summarize(warm_l2),
+        criterions_warm_l1=summarize(warm_l1),
+        criterions_batch_cold=timed(lambda: req.criterions_batch(batch), repeat=1),
+        unique_calls_per_address=len(req.plan(batch[0])),
+    )
@@ -0,0 +1,58 @@
+import re
+import subprocess
+import sys
+import time
+
+from typing import Dict, List
+
+from benchmarks.common import summarize
+
+
+# what a fresh process pays before the app can draw its first page, measured
+# in subprocesses since imports are cached for the rest of this one
+
+modules = ["src.model", "src.req", "src.app"]
+
+_line = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _importtime(module: str) -> List[Dict]:
+    # one row per module imported, cumulative microseconds included its own imports
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         capture_output=True, text=True, check=True)
+    rows = []
+    for match in _line.finditer(out.stderr):
+        self_us, cumulative_us, indent, name = match.groups()
+        rows.append(dict(module=name, depth=len(indent) // 2, self_us=int(self_us), cumulative_us=int(cumulative_us)))
+    return rows
+
+
+def _wall(module: str, repeat: int) -> Dict[str, float]:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", f"import {module}"], check=True, capture_output=True)
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+
+def run(repeat: int = 5, top: int = 10) -> Dict:
+    results = {}
+    for module in modules:
+        try:
+            rows = _importtime(module)
+        except subprocess.CalledProcessError as e:
+            # e.g. streamlit is not installed where the benchmark runs
+            results[module] = dict(error=e.stderr.strip().splitlines()[-1])
+            continue
+        # importtime prints a module after everything it imported, the rows
+        # since the previous top-level one are the measured module's tree
+        end = max(i for i, row in enumerate(rows) if row["module"] == module and row["depth"] == 0)
+        begin = max((i + 1 for i, row in enumerate(rows[:end]) if row["depth"] == 0), default=0)
+        heaviest = sorted((row for row in rows[begin:end] if row["depth"] == 1), key=lambda row: -row["cumulative_us"])
+        results[module] = dict(
+            wall_seconds=_wall(module, repeat),
+            cumulative_us=rows[end]["cumulative_us"],
+            heaviest=[dict(module=row["module"], cumulative_us=row["cumulative_us"]) for row in heaviest[:top]],
+        )
+    return results
@@ -0,0 +1,22 @@
+import json
+
+from typing import Dict
+
+from deepdiff import DeepHash
+
+from benchmarks.common import per_call
+from src import cache
+
+
+def run(n: int = 2000) -> Dict:
+    payload = {
+        "size": "100",
+        "address": {"code": 91224, "city": "Łódź", "street": "ALEKSANDROWSKA", "buildingNumber": 104},
+        "nearestPOI": "D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY"
+    }
+    payload_str = json.dumps(payload)
+    return dict(
+        # how the old per-file cache named its files
+        deephash_seconds=per_call(lambda: str(DeepHash(payload_str)[payload_str]), n),
+        cache_key_seconds=per_call(lambda: cache.key("bik-api-4/punkty-zainteresowania-adres", payload), n),
+    )
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+
+from typing import Dict, List
+
+from benchmarks.common import timed
+from src import geo, model
+
+
+def _variants(n: int) -> List[Dict]:
+    r = random.Random(0)
+    return [{t.source: r.uniform(0, 5000) for t in model.transforms.values()} for _ in range(n)]
+
+
+def _page_analysis_loop(variants: List[Dict], thresholds: Dict, weights: Dict) -> List:
+    # the per-variant dict path page_analysis used before model.score
+    weights_norm = sum(weights.values())
+    results = []
+    for variant in variants:
+        fine_u = model.partial_utilities(thresholds, variant)
+        coarse_u = {}
+        for coarse, fine_criteria in model.coarse_criteria.items():
+            coarse_u[coarse] = weights[coarse] / weights_norm * np.mean([fine_u[fine] for fine in fine_criteria])
+        results.append(np.sum(list(coarse_u.values())))
+    return sorted(results, reverse=True)
+
+
+def _page_analysis_batch(variants: List[Dict], thresholds: Dict, weights: Dict) -> np.ndarray:
+    _, _, scores = model.score(variants, thresholds, weights)
+    return np.argsort(-scores)
+
+
+def run(sizes=(10, 1000, 100000)) -> Dict:
+    weights = model.coarse_profiles()['Student']
+    thresholds = model.default_thresholds
+    results = {}
+    for n in sizes:
+        variants = _variants(n)
+        X = model.criteria_matrix(variants)
+        t = model.threshold_vector(thresholds)
+        repeat = 1 if n >= 100000 else 5
+        results[n] = dict(
+            partial_utilities=timed(lambda: [model.partial_utilities(thresholds, v) for v in variants], repeat),
+            page_analysis_loop=timed(lambda: _page_analysis_loop(variants, thresholds, weights), repeat),
+            page_analysis_batch=timed(lambda: _page_analysis_batch(variants, thresholds, weights), repeat),
+            batch_partial_utilities=timed(lambda: model.batch_partial_utilities(X, t), repeat),
+        )
+    # the Analysis page's stability check at its largest setting
+    means = np.nan_to_num(model.batch_coarse_means(model.batch_partial_utilities(
+        model.criteria_matrix(_variants(1000)), model.threshold_vector(thresholds))))
+    results['rank_stability'] = dict(
+        samples_10000_top_10=timed(lambda: model.rank_stability(means, weights, 10000, top=10), 3),
+        samples_10000_all_ranks=timed(lambda: model.rank_stability(means, weights, 10000), 3),
+    )
+    # UTM to lat/lon of a city-wide map, point by point and in one pass
+    r = np.random.default_rng(0)
+    x, y = r.uniform(380000, 405000, 100000), r.uniform(5725000, 5745000, 100000)
+    results['latlon'] = dict(
+        points_1000_loop=timed(lambda: [geo.to_latlon(a, b, 34) for a, b in zip(x[:1000], y[:1000])], 3),
+        points_100000_batch=timed(lambda: geo.to_latlon(x, y, 34), 3),
+    )
+    return results
@@ -0,0 +1,32 @@
+import time
+
+import numpy as np
+
+from typing import Callable, Dict, List
+
+
+def summarize(seconds: List[float]) -> Dict[str, float]:
+    s = np.array(seconds)
+    return dict(n=len(s), mean=float(s.mean()), p50=float(np.percentile(s, 50)),
+                p95=float(np.percentile(s, 95)), min=float(s.min()), max=float(s.max()))
+
+
+def timed(fun: Callable, repeat: int = 5) -> Dict[str, float]:
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fun()
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+
+def per_call(fun: Callable, n: int) -> float:
+    # mean seconds per call over n calls
+    start = time.perf_counter()
+    for _ in range(n):
+        fun()
+    return (time.perf_counter() - start) / n
+
+
+def addresses(n: int, street: str = "ALEKSANDROWSKA") -> List[Dict]:
+    return [dict(code=91224, city="Łódź", street=street, buildingNumber=i + 1) for i in range(n)]
@@ -0,0 +1,71 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from src import mock_gateway
+
+
+# python -m benchmarks.run --out bench.json
+#
+# Runs against a local src.mock_gateway and a throwaway cache directory, so no
+# credentials are needed and runs are comparable between machines and commits.
+
+suites = ["fetch", "cache", "keys", "scoring", "import"]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark fetch, cache and scoring hot paths.")
+    parser.add_argument("--out", default="bench.json")
+    parser.add_argument("--only", nargs="*", choices=suites, default=suites)
+    parser.add_argument("--latency", type=float, default=0.02, help="mock gateway latency (s)")
+    parser.add_argument("--jitter", type=float, default=0.01)
+    parser.add_argument("--addresses", type=int, default=20)
+    args = parser.parse_args()
+
+    gateway = mock_gateway.serve(latency=args.latency, jitter=args.jitter)
+    tmp = tempfile.mkdtemp(prefix="homeaware-bench-")
+    connection = os.path.join(tmp, "connection.json")
+    with open(connection, "w") as f:
+        json.dump(dict(cache_dir=os.path.join(tmp, "cache")), f)
+    # must be set before src.req is first used
+    os.environ["HOMEAWARE_GATEWAY"] = gateway.url
+    os.environ["HOMEAWARE_CONNECTION"] = connection
+
+    results = dict(
+        meta=dict(
+            time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+            revision=_git_revision(),
+            python=sys.version.split()[0],
+            platform=platform.platform(),
+            gateway_latency=args.latency,
+            gateway_jitter=args.jitter,
+        )
+    )
+    for suite in args.only:
+        print(f"running {suite}...", file=sys.stderr)
+        module = __import__(f"benchmarks.bench_{suite}", fromlist=["run"])
+        if suite == "fetch":
+            results[suite] = module.run(n_addresses=args.addresses)
+        else:
+            results[suite] = module.run()
+    results["meta"]["gateway_requests"] = dict(gateway.counts)
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {args.out}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
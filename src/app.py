@@ -1,37 +1,33 @@
+import os
 import re
 import sys
+import time
 
 sys.path.append(".")
 import streamlit as st
 import pandas as pd
 import numpy as np
-import graphviz as graphviz
-import seaborn as sns
-import matplotlib.pyplot as plt
-import plotly.graph_objects as go
-import plotly.express as px
 
-from src.req import criterions
-from src.model import partial_utilities, global_utility, default_thresholds
-
-plt.style.use('ggplot')
+from src import columnar, metrics, prefetch
+from src.preference import PreferenceModel, group_means
+from src.req import CRITERIA, address_of, criterions, stream_criterions
+from src.model import (
+    IncrementalScorer, coarse_criteria, coarse_groups, coarse_profiles, default_thresholds, fine_criteria,
+    rank_stability, required_criteria, score
+)
 
 sess = st.session_state
 
 app_name = "__homeAware__"
 
-coarse_criteria = {
-    'Education': [ 'education', 'university' ],
-    'Safety': ['car_collisions', 'consumer_expenses', 'cr3', 'crimes', 'geoscore'],
-    'Transport': ['garages', 'tram_stop', 'bus_stop', 'railway_station'],
-    'Services': ['parcel_lockers', 'post_office', 'health', 'culture_entertainment', 'mall'],
-    'Extraversion': ['between_20_30', 'dating_apps'],
-    'Community': ['over_60', 'sport', 'worship'],
-    'Nature': ['nature'],
-    'Comfort': ['airport', 'civil_services', 'railway_tracks', 'freeways'],       
-}
 
-coarse_criteria_profiles = pd.read_csv('src/presets_coarse.csv', index_col='name').to_dict()
+@st.experimental_memo(show_spinner=False)
+def read_coarse_profiles():
+    return coarse_profiles()
+
+# profile name -> coarse group -> weight, read once per server and copied on
+# every rerun, so sessions are free to change their weights
+coarse_criteria_profiles = read_coarse_profiles()
 
 demo_variants = [
     {'City': 'Łódź', 'Street': 'ALEKSANDROWSKA', 'Building No.': '104', 'Postal Code': '91224'},
@@ -42,6 +38,7 @@ demo_variants = [
     #{'City': 'Łódź', 'Street': 'TATRZAŃSKA', 'Building No.': '28', 'Postal Code': '93115'},
 ]
 
+@st.experimental_memo(show_spinner=False)
 def read_profiles():
     df = pd.read_csv('src/presets.csv', index_col='function')
     return {col_name: df[col_name].to_dict() for col_name in df.columns}
@@ -90,9 +87,81 @@ hidden_criteria = {
 }
 
 
-@st.experimental_memo
-def variant_details(x):
-    return criterions(city=x['City'], street=x['Street'], buildingNumber=int(x['Building No.']), code=int(x['Postal Code']))
+@st.experimental_singleton
+def criteria_dataset():
+    # precomputed criteria (src.columnar), memory-mapped once and shared by
+    # every session
+    path = os.environ.get("HOMEAWARE_DATASET", "src/.cache/criteria.npy")
+    if not os.path.exists(path):
+        return None
+    return columnar.Table.load(path)
+
+
+@st.experimental_singleton
+def dataset_points():
+    # stored lat/lon of the whole dataset; rows may be of several cities, so
+    # ones with only UTM coordinates are left out rather than guessed
+    points = criteria_dataset().latlon()
+    return pd.DataFrame(points[~np.isnan(points).any(axis=1)], columns=['lat', 'lon'])
+
+
+def dataset_details(x, only=None):
+    dataset = criteria_dataset()
+    details = dataset.get(address_of(x)) if dataset is not None else None
+    names = only or [criterion.__name__ for criterion in CRITERIA]
+    if details is None or any(name not in details for name in names):
+        return None
+    return {name: details[name] for name in names}
+
+
+# how long the app reuses criteria it already has; kept below every endpoint
+# TTL (src.req._ttl), after that criterions() applies its own expiry
+details_ttl = 3600
+
+
+@st.experimental_memo(ttl=details_ttl)
+def variant_details(x, only=None):
+    return dataset_details(x, only) or criterions(**address_of(x), only=only)
+
+
+def scored_criteria():
+    # groups the user gave no weight can't change the ranking, their criteria
+    # are only fetched once the user asks for them
+    if sess.show_variant_details:
+        return None
+    return tuple(required_criteria(sess.weights))
+
+
+def details_key(x, only):
+    return format_variant(x), only
+
+
+def stream_details(variants, only, on_update, interval=0.25):
+    # collects criterions() results as they arrive, on_update gets the partial
+    # details at most every `interval` seconds and once at the end. Complete
+    # details are kept in the session for details_ttl with the time they
+    # came in, reruns only stream what is missing
+    keys = [details_key(x, only) for x in variants]
+    now = time.time()
+    for x, key in zip(variants, keys):
+        if key in sess.details and now - sess.details[key][0] > details_ttl:
+            del sess.details[key]
+        if key not in sess.details:
+            found = dataset_details(x, only)
+            if found is not None:
+                sess.details[key] = now, found
+    details = [dict(sess.details[key][1]) if key in sess.details else {} for key in keys]
+    missing = [i for i, key in enumerate(keys) if key not in sess.details]
+    last_update = time.time()
+    for j, name, value in stream_criterions([address_of(variants[i]) for i in missing], only):
+        details[missing[j]][name] = value
+        if time.time() - last_update > interval:
+            on_update(details)
+            last_update = time.time()
+    for i in missing:
+        sess.details[keys[i]] = time.time(), details[i]
+    on_update(details)
+    return details
 
 
 def format_variant(x):
@@ -121,18 +190,25 @@ def page_variants():
         elif not postcode:
             st.error('Postal Code must be non-empty')
         else:
-            sess.variants.append({'City': city, 'Street': street, 'Building No.': building_no, 'Postal Code': postcode})
+            variant = {'City': city, 'Street': street, 'Building No.': building_no, 'Postal Code': postcode}
+            sess.variants.append(variant)
+            # start fetching right away, the map and Analysis page pick it up from the cache
+            prefetch.enqueue(address_of(variant), scored_criteria())
 
     if sess.variants:
         st.markdown('## My locations')
         st.table(pd.DataFrame(sess.variants))
 
-        coords = []
-        for variant in sess.variants:
-            details = variant_details(variant)
-            lat, lon = details['latlon']
-            coords.append(dict(lat=lat, lon=lon))
-        st.map(pd.DataFrame(coords))
+        # pins appear one by one as the coordinates come in
+        map_slot = st.empty()
+        def show_map(all_details):
+            points = np.array([d['latlon'] for d in all_details if 'latlon' in d], dtype=float).reshape(-1, 2)
+            if len(points):
+                map_slot.map(pd.DataFrame(points, columns=['lat', 'lon']))
+        stream_details(sess.variants, ('latlon',), show_map)
+
+    if criteria_dataset() is not None and st.checkbox('Show every precomputed address'):
+        st.map(dataset_points())
 
     if sess.show_variant_details:
         st.markdown('## Location details')
@@ -185,6 +261,7 @@ def page_preferences():
             sess.preferences.append((a, b))
 
     if sess.preferences:
+        import graphviz
         col2.markdown('### Preference graph')
         g = graphviz.Digraph(node_attr=dict(shape='box', style='rounded'))
         for better, worse in sess.preferences:
@@ -192,16 +269,25 @@ def page_preferences():
         col2.graphviz_chart(g, use_container_width=True)
 
     st.markdown('### Profile adjustment')
-    st.markdown('Your profile was adjusted based on your preferences')
-    coarse_profile = coarse_criteria_profiles[sess.profile]
-    n = len(coarse_profile)
+    # weights closest to the current profile that agree with the preferences,
+    # the solver starts from the previous answer so each new pair is quick
+    by_name = {format_variant(x): x for x in sess.variants}
+    pairs = [(a, b) for a, b in sess.preferences if a in by_name and b in by_name]
+    names = sorted({name for pair in pairs for name in pair})
+    means = dict(zip(names, group_means([variant_details(by_name[name]) for name in names], sess.thresholds)))
+    adjusted = sess.preference_model.update(pairs, means, sess.weights)
+    if pairs:
+        st.markdown(f'Your profile was adjusted based on your preferences ({sess.preference_model.violated} of {len(pairs)} still disagree)')
+    else:
+        st.markdown('Add a preference to adjust your profile')
     n_cols = 4
     cols = st.columns(n_cols)
-    for i, (group, weight) in enumerate(coarse_profile.items()):
-        delta = np.random.randint(-10, 10)
-        weight = max(0, min(100, weight * 100 + delta))
+    for i, (group, weight) in enumerate(adjusted.items()):
+        weight = min(100, round(weight * 100))
+        delta = weight - round(sess.weights[group] * 100)
         cols[i % n_cols].metric(group, f'{weight}%', delta=f'{delta}%')
-            
+    if pairs and st.button('Use adjusted profile'):
+        sess.weights = {group: min(1.0, adjusted[group]) for group in sess.weights}
 
 
 def page_analysis():
@@ -211,24 +297,56 @@ def page_analysis():
 
     st.markdown('## Final ranking')
 
-    weights_norm = sum(sess.weights.values())
+    # the table fills in and re-sorts while criteria arrive; until a location
+    # is complete its score only counts the groups that are
+    only = scored_criteria()
+    n_criteria = len(only or CRITERIA)
+    ranking_slot = st.empty()
+    def show_ranking(all_details):
+        _, partial_coarse_u, _ = score(all_details, sess.thresholds, sess.weights)
+        df = pd.DataFrame(sess.variants).drop(columns='MatchScore', errors='ignore')
+        df['MatchScore'] = np.nansum(partial_coarse_u, axis=1)
+        df['Loaded'] = [f'{len(d)}/{n_criteria}' for d in all_details]
+        df = df.sort_values('MatchScore', ascending=False)
+        df['Rank'] = np.arange(len(df)) + 1
+        ranking_slot.table(df)
+    all_details = stream_details(sess.variants, only, show_ranking)
+    # a slider move only recomputes what its threshold or weight affects; keys
+    # carry the time the details came in, so refreshed details are rescored
+    keys = [(key, sess.details[key][0]) for key in (details_key(variant, only) for variant in sess.variants)]
+    fine_u, coarse_u, scores = sess.scorer.score(keys, all_details, sess.thresholds, sess.weights)
     results = []
-    for i, variant in enumerate(sess.variants):
-        details = variant_details(variant)
-        fine_u = partial_utilities(sess.thresholds, details)
-        coarse_u = {}
-        for coarse, fine_criteria in coarse_criteria.items():
-            coarse_u[coarse] = sess.weights[coarse] / weights_norm * np.mean([fine_u[fine] for fine in fine_criteria])
-
-        score = np.sum(list(coarse_u.values()))
-        variant['MatchScore'] = score
-        results.append(dict(score=score, coarse=coarse_u, fine=fine_u, variant=variant, details=details))
+    for i, (variant, details) in enumerate(zip(sess.variants, all_details)):
+        variant['MatchScore'] = scores[i]
+        results.append(dict(
+            score=scores[i],
+            coarse=dict(zip(coarse_groups, coarse_u[i])),
+            fine=dict(zip(fine_criteria, fine_u[i])),
+            variant=variant,
+            details=details
+        ))
 
     ranking = sorted(results, key=lambda x: x['score'], reverse=True)
     ranking_df = pd.DataFrame([x['variant'] for x in ranking])
     ranking_df['Rank'] = np.arange(len(ranking)) + 1
 
-    st.table(ranking_df)
+    ranking_slot.table(ranking_df)
+
+    with st.expander('How stable is this ranking?'):
+        # the same locations ranked under thousands of weights close to yours
+        cols = st.columns(3)
+        samples = cols[0].select_slider('Samples', options=[1000, 2000, 5000, 10000], value=5000)
+        spread = cols[1].slider('Weight spread', min_value=5, max_value=30, value=10, step=5, format='±%d%%') / 100
+        method = cols[2].radio('Sampling', ['dirichlet', 'uniform'])
+        top = min(len(results), 10)
+        start = time.time()
+        P = rank_stability(sess.scorer.means(), sess.weights, samples, spread, method, top=top)
+        order = np.argsort(-np.asarray(scores), kind='stable')
+        stability_df = pd.DataFrame(P[order] * 100, columns=[f'#{r}' for r in range(1, top + 1)],
+                                    index=[format_variant(results[i]['variant']) for i in order])
+        stability_df['Top 3'] = stability_df.iloc[:, :3].sum(axis=1)
+        st.table(stability_df.round(1).astype(str) + '%')
+        st.caption(f'Share of {samples} sampled weight vectors under which each location gets each rank ({time.time() - start:.2f}s)')
 
     st.markdown('## Comparison')
 
@@ -251,6 +369,8 @@ def page_analysis():
     result = st.selectbox('Location to analyze', results, format_func=lambda x: format_variant(x['variant']))
     if result is None: return
 
+    # plotly takes a while to import, only this page needs it
+    import plotly.graph_objects as go
     fig = go.Figure(go.Waterfall(
         y=list(result['coarse'].keys()),
         x=list(result['coarse'].values()),
@@ -266,6 +386,23 @@ def page_analysis():
         st.write(result['fine'])
 
 
+def sidebar_metrics():
+    snapshot = metrics.snapshot()
+    st.sidebar.markdown('### Metrics')
+    for title, name, columns in [
+        ('Gateway latency (s)', 'homeaware_gateway_request_seconds', ['endpoint', 'count', 'mean']),
+        ('Criterion latency (s)', 'homeaware_criterion_seconds', ['criterion', 'count', 'mean']),
+    ]:
+        rows = snapshot['histograms'].get(name)
+        if rows:
+            st.sidebar.markdown(f'**{title}**')
+            st.sidebar.dataframe(pd.DataFrame(rows)[columns].sort_values('mean', ascending=False))
+    lookups = snapshot['counters'].get('homeaware_cache_lookups_total')
+    if lookups:
+        st.sidebar.markdown('**Cache lookups**')
+        st.sidebar.dataframe(pd.DataFrame(lookups).set_index('result'))
+
+
 def main():
     # initialize state
     if 'variants' not in sess:
@@ -278,6 +415,12 @@ def main():
         sess.profile = 'Student'
     if 'weights' not in sess:
         sess.weights = coarse_criteria_profiles[sess.profile]
+    if 'details' not in sess:
+        sess.details = {}
+    if 'scorer' not in sess:
+        sess.scorer = IncrementalScorer()
+    if 'preference_model' not in sess:
+        sess.preference_model = PreferenceModel()
 
     st.set_page_config(
         page_title="homeAware",
@@ -290,13 +433,18 @@ def main():
     pages = {
         '1️. Locations': page_variants,
         '2. User Profile': page_profile,
-        '3. Analysis': page_analysis,
+        '3. Preferences': page_preferences,
+        '4. Analysis': page_analysis,
     }
     name = st.sidebar.radio('Select step', pages.keys(), index=0)
 
     st.sidebar.write('Demo controls')
     demo = st.sidebar.checkbox('Show demo locations', value=True)
     sess.show_variant_details = st.sidebar.checkbox('Show location details', value=False)
+    if st.sidebar.checkbox('Show metrics', value=False):
+        sidebar_metrics()
+    if 'HOMEAWARE_METRICS_PORT' in os.environ:
+        metrics.serve(int(os.environ['HOMEAWARE_METRICS_PORT']))
 
     if demo:
         sess.variants = demo_variants
@@ -0,0 +1,244 @@
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:
+    # no cross-process locking on Windows, replicas may then fetch twice
+    fcntl = None
+
+
+def key(endpoint: str, payload: Any) -> str:
+    canonical = json.dumps(payload, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return endpoint + "==" + hashlib.sha1(canonical.encode("utf-8")).hexdigest()
+
+
+class LRU:
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, k: str) -> Optional[Any]:
+        with self._lock:
+            if k not in self._data:
+                return None
+            self._data.move_to_end(k)
+            return self._data[k]
+
+    def put(self, k: str, value: Any):
+        with self._lock:
+            self._data[k] = value
+            self._data.move_to_end(k)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class FileLocks:
+    # advisory locks shared by every process using the same cache directory;
+    # keys are striped over a fixed number of files per namespace so the
+    # directory stays small. A thread must never hold two locks of the same
+    # namespace at once, two keys may share a stripe
+
+    def __init__(self, directory: str, stripes: int = 1024):
+        self.directory = directory
+        self.stripes = stripes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, namespace: str, k: str) -> str:
+        stripe = int(hashlib.sha1(k.encode("utf-8")).hexdigest(), 16) % self.stripes
+        return os.path.join(self.directory, f"{namespace}-{stripe}.lock")
+
+    @contextmanager
+    def hold(self, namespace: str, k: str):
+        with open(self._path(namespace, k), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class Store:
+    # single sqlite file indexed by key; least recently used rows are evicted
+    # once the stored responses grow over max_bytes. WAL mode lets several
+    # processes read while one writes, every put is a single transaction
+
+    _evict_every = 100
+    # accessed only orders evictions, and those only happen in put_many: a
+    # read notes the key for the next put_many instead of writing, and only
+    # if its accessed time is older than this many seconds
+    _touch_every = 3600
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._puts = 0
+        self._touched = {}
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                endpoint TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+
+    def get(self, k: str) -> Optional[Any]:
+        entry = self.entry(k)
+        return None if entry is None else entry[0]
+
+    def entry(self, k: str, touch: bool = True) -> Optional[Tuple[Any, float]]:
+        # (value, time it was stored); touch=False for probes that should not
+        # keep the row from being evicted
+        with self._lock:
+            row = self._db.execute("SELECT response, created, accessed FROM responses WHERE key = ?", (k,)).fetchone()
+            if row is None:
+                return None
+            now = time.time()
+            if touch and now - row[2] > self._touch_every:
+                self._touched[k] = now
+        return json.loads(row[0]), row[1]
+
+    def put(self, k: str, endpoint: str, payload: Any, value: Any):
+        self.put_many([(k, endpoint, payload, value)])
+
+    def put_many(self, items):
+        now = time.time()
+        rows = []
+        for k, endpoint, payload, value in items:
+            response = json.dumps(value, ensure_ascii=False)
+            rows.append((k, endpoint, json.dumps(payload, ensure_ascii=False), response, len(response), now, now))
+        with self._lock:
+            if self._touched:
+                touched, self._touched = self._touched, {}
+                self._db.executemany("UPDATE responses SET accessed = ? WHERE key = ?", [(t, k) for k, t in touched.items()])
+            self._db.executemany("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._db.commit()
+            before, self._puts = self._puts, self._puts + len(rows)
+            if before // self._evict_every != self._puts // self._evict_every:
+                self._evict()
+
+    def _evict(self):
+        total, = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used rows until we are 10% below the limit
+        excess = total - int(self.max_bytes * 0.9)
+        rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed")
+        victims = []
+        for k, size in rows:
+            if excess <= 0: break
+            victims.append((k,))
+            excess -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+        self._db.commit()
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            entries, size = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        return dict(entries=entries, bytes=size)
+
+
+class Cache:
+    def __init__(self, path: str, l1_size: int = 4096, max_bytes: int = 512 * 2**20):
+        self.l1 = LRU(l1_size)
+        self.l2 = Store(path, max_bytes)
+        self.locks = FileLocks(os.path.join(os.path.dirname(path), "locks"))
+        self._counters_lock = threading.Lock()
+        self.counters = dict(l1_hits=0, l2_hits=0, misses=0)
+
+    def _count(self, name: str):
+        with self._counters_lock:
+            self.counters[name] += 1
+
+    def get(self, endpoint: str, payload: Any, count: bool = True) -> Optional[Any]:
+        entry = self.entry(endpoint, payload, count)
+        return None if entry is None else entry[0]
+
+    def entry(self, endpoint: str, payload: Any, count: bool = True) -> Optional[Tuple[Any, float]]:
+        # (value, time it was stored), for callers that care about its age
+        k = key(endpoint, payload)
+        entry = self.l1.get(k)
+        if entry is not None:
+            if count: self._count("l1_hits")
+            return entry
+        entry = self.l2.entry(k, touch=count)
+        if entry is not None:
+            if count: self._count("l2_hits")
+            self.l1.put(k, entry)
+            return entry
+        if count: self._count("misses")
+        return None
+
+    def shared_entry(self, endpoint: str, payload: Any) -> Optional[Tuple[Any, float]]:
+        # entry() from the store only: L1 may still hold a value that another
+        # process has replaced since. For rechecks inside single_flight
+        k = key(endpoint, payload)
+        entry = self.l2.entry(k, touch=False)
+        if entry is not None:
+            self.l1.put(k, entry)
+        return entry
+
+    @contextmanager
+    def single_flight(self, endpoint: str, payload: Any):
+        # only one holder across all processes computes a missing value; the
+        # others block here and should check the cache again once inside
+        with self.locks.hold(endpoint.split("/")[0], key(endpoint, payload)):
+            yield
+
+    def put(self, endpoint: str, payload: Any, value: Any):
+        k = key(endpoint, payload)
+        self.l1.put(k, (value, time.time()))
+        self.l2.put(k, endpoint, payload, value)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(**self.counters, l1_entries=len(self.l1), **{f"l2_{k}": v for k, v in self.l2.stats().items()})
+
+
+def import_legacy(cache: Cache, cache_dir: str) -> int:
+    # the old layout kept one "{endpoint}=={hash}.json" JSONL file per payload hash
+    items = []
+    for path in glob.glob(os.path.join(cache_dir, "**", "*==*.json"), recursive=True):
+        endpoint = os.path.relpath(path, cache_dir).split("==")[0].replace(os.sep, "/")
+        with open(path, "r") as f:
+            for line in f:
+                if not line.strip(): continue
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    continue
+                items.append((key(endpoint, data["input"]), endpoint, data["input"], data["output"]))
+    cache.l2.put_many(items)
+    return len(items)
+
+
+if __name__ == '__main__':
+    from src.req import _get_cache
+    print(_get_cache().stats())
@@ -0,0 +1,203 @@
+import hashlib
+import json
+import os
+import sys
+
+import numpy as np
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from src import geo
+
+
+# Criteria of many addresses in one NumPy structured array: a row per address,
+# float32 columns in a fixed order and a mask of the criteria that are missing.
+# Saved with np.save, a city-wide dataset is memory-mapped on load, so it opens
+# instantly and every Streamlit session reads the same pages without a copy.
+
+# scalar criteria, in file order; never reorder, only append (and rebuild files)
+columns = (
+    "airports", "between_20_30", "bus_stop", "car_collisions", "civil_services", "consumer_expenses", "cr3",
+    "crimes", "culture_entertainment", "dating_apps", "education", "freeways", "garages", "geoscore", "health",
+    "mall", "nature", "over_60", "parcel_lockers", "post_office", "price", "railway_station", "railway_tracks",
+    "sport", "tram_stop", "university", "worship",
+)
+# criteria with two values; coordinates are UTM meters and stay float64 so
+# grid cells computed from them match the ones src.req uses
+pairs = {
+    "coordinates": (("coordinates_x", "f8"), ("coordinates_y", "f8")),
+    "latlon": (("lat", "f4"), ("lon", "f4")),
+}
+# criterion names, in the order of the missing mask
+names = columns + tuple(pairs)
+
+dtype = np.dtype(
+    [("key", "u8")]
+    + [(name, "f4") for name in columns]
+    + [field for fields in pairs.values() for field in fields]
+    + [("missing", "?", (len(names),))]
+)
+
+
+def address_key(address: Dict) -> int:
+    # 64 bits of the sha1 of the criterions() arguments
+    canonical = json.dumps(
+        [int(address["code"]), str(address["city"]), str(address["street"]), int(address["buildingNumber"])],
+        ensure_ascii=False, separators=(",", ":")
+    )
+    return int(hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16], 16)
+
+
+class Table:
+    # grows like a list; a loaded (read-only) table is copied into memory
+    # on the first append
+
+    def __init__(self, data: Optional[np.ndarray] = None, capacity: int = 1024):
+        if data is None:
+            data = np.zeros(capacity, dtype)
+            size = 0
+        else:
+            size = len(data)
+        self._data = data
+        self._size = size
+        self._index = None
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "Table":
+        data = np.load(path, mmap_mode="r" if mmap else None)
+        if data.dtype != dtype:
+            raise ValueError(f"{path} was written with another criterion schema, rebuild it")
+        return cls(data)
+
+    def save(self, path: str):
+        # written next to the target and renamed, readers never see half a file
+        tmp = path + ".tmp.npy"
+        np.save(tmp, self.data)
+        os.replace(tmp, path)
+
+    @property
+    def data(self) -> np.ndarray:
+        return self._data[:self._size]
+
+    def __len__(self) -> int:
+        return self._size
+
+    def _lookup(self) -> Dict[int, int]:
+        if self._index is None:
+            self._index = dict(zip(self.data["key"].tolist(), range(self._size)))
+        return self._index
+
+    def row(self, address: Dict) -> Optional[int]:
+        return self._lookup().get(address_key(address))
+
+    def __contains__(self, address: Dict) -> bool:
+        return self.row(address) is not None
+
+    def _reserve(self, n: int):
+        if self._data.flags.writeable and len(self._data) >= n:
+            return
+        data = np.zeros(max(n, 2 * len(self._data), 1024), dtype)
+        data[:self._size] = self.data
+        self._data = data
+
+    def append(self, address: Dict, details: Dict):
+        # criteria missing from details keep their old value (or stay missing)
+        k = address_key(address)
+        i = self._lookup().get(k)
+        if i is None:
+            self._reserve(self._size + 1)
+            i = self._size
+            self._data[i] = np.zeros(1, dtype)[0]
+            self._data[i]["key"] = k
+            self._data[i]["missing"] = True
+            self._index[k] = i
+            self._size += 1
+        elif not self._data.flags.writeable:
+            self._reserve(self._size)
+        row = self._data[i]
+        for j, name in enumerate(names):
+            value = details.get(name)
+            if value is None:
+                continue
+            if name in pairs:
+                for (field, _), v in zip(pairs[name], value):
+                    row[field] = v
+            else:
+                row[name] = value
+            row["missing"][j] = False
+
+    def extend(self, items: Iterable[Tuple[Dict, Dict]]):
+        for address, details in items:
+            self.append(address, details)
+
+    def update(self, other: "Table"):
+        # upsert every row of other, its values win where they are not missing
+        index = self._lookup()
+        rows = other.data
+        new, old = [], []
+        for i, k in enumerate(rows["key"].tolist()):
+            if k in index:
+                old.append(i)
+            else:
+                index[k] = self._size + len(new)
+                new.append(i)
+        self._reserve(self._size + len(new))
+        self._data[self._size:self._size + len(new)] = rows[new]
+        self._size += len(new)
+        for row in rows[old]:
+            mine = self._data[index[int(row["key"])]]
+            for j, name in enumerate(names):
+                if row["missing"][j]:
+                    continue
+                for field in [field for field, _ in pairs[name]] if name in pairs else [name]:
+                    mine[field] = row[field]
+                mine["missing"][j] = False
+
+    def get(self, address: Dict) -> Optional[Dict]:
+        # criterions()-like dict of the criteria that are not missing
+        i = self.row(address)
+        if i is None:
+            return None
+        row = self._data[i]
+        details = {}
+        for j, name in enumerate(names):
+            if row["missing"][j]:
+                continue
+            if name in pairs:
+                details[name] = tuple(float(row[field]) for field, _ in pairs[name])
+            else:
+                details[name] = float(row[name])
+        return details
+
+    def matrix(self, criteria: List[str], rows=slice(None)) -> np.ndarray:
+        # N x C of the given scalar criteria, NaN where missing; e.g. the
+        # model.fine_sources columns model.score_matrix expects
+        data = self.data[rows]
+        X = np.empty((len(data), len(criteria)))
+        for c, name in enumerate(criteria):
+            X[:, c] = data[name]
+            X[data["missing"][:, names.index(name)], c] = np.nan
+        return X
+
+    def latlon(self, zone: Optional[Tuple[int, bool]] = None, rows=slice(None)) -> np.ndarray:
+        # N x 2 of the stored lat, lon, NaN where missing. Rows don't know
+        # their city, so only for a table of a single city pass its zone
+        # (req.zone) to convert rows that have just UTM coordinates, in one pass
+        data = self.data[rows]
+        missing = data["missing"]
+        points = np.column_stack([data["lat"], data["lon"]]).astype(float)
+        points[missing[:, names.index("latlon")]] = np.nan
+        convert = missing[:, names.index("latlon")] & ~missing[:, names.index("coordinates")]
+        if zone is not None and convert.any():
+            points[convert] = np.column_stack(
+                geo.to_latlon(data["coordinates_x"][convert], data["coordinates_y"][convert], *zone))
+        return points
+
+    def missing(self) -> Dict[str, int]:
+        counts = self.data["missing"].sum(axis=0)
+        return {name: int(n) for name, n in zip(names, counts)}
+
+
+if __name__ == '__main__':
+    table = Table.load(sys.argv[1] if len(sys.argv) > 1 else "src/.cache/criteria.npy")
+    print(f"{len(table)} addresses, missing:", {k: v for k, v in table.missing().items() if v})
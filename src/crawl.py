@@ -0,0 +1,204 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from src import columnar, req
+from src.prefetch import read_addresses
+
+
+# Precomputes the criteria of a whole address list into one columnar dataset:
+#
+#   python -m src.crawl addresses.csv --out src/.cache/criteria.npy --shards 4 --rate 20
+#
+# Address i goes to shard i % shards, every shard runs in its own process and
+# keeps its results and progress in STATE/shard-K.npy and .json, so a crash or
+# an exhausted quota resumes where it stopped. All processes share one gateway
+# request rate. Once every shard is through, the shards are merged into OUT.
+
+
+class RateLimit:
+    # at most `rate` gateway requests per second summed over every process,
+    # bursts of up to `burst` requests after a pause
+
+    def __init__(self, rate: float, burst: int = 1, context=multiprocessing):
+        self.interval = 1 / rate
+        self.burst = burst
+        self._next = context.Value("d", 0.0)
+
+    def wait(self, endpoint: Optional[str] = None):
+        with self._next.get_lock():
+            now = time.time()
+            t = max(self._next.value, now - (self.burst - 1) * self.interval)
+            self._next.value = t + self.interval
+        if t > now:
+            time.sleep(t - now)
+
+
+def _shard_paths(state: str, shard: int):
+    return os.path.join(state, f"shard-{shard}.npy"), os.path.join(state, f"shard-{shard}.json")
+
+
+def _read_checkpoint(state: str, shard: int) -> Dict:
+    # done: addresses of the shard gone through, failed: which of them failed
+    _, checkpoint_path = _shard_paths(state, shard)
+    if not os.path.exists(checkpoint_path):
+        return dict(done=0, failed=[])
+    with open(checkpoint_path) as f:
+        return json.load(f)
+
+
+def _load_checkpoint(state: str, shard: int):
+    checkpoint = _read_checkpoint(state, shard)
+    if not checkpoint["done"]:
+        return columnar.Table(), checkpoint
+    return columnar.Table.load(_shard_paths(state, shard)[0], mmap=False), checkpoint
+
+
+def _save_checkpoint(state: str, shard: int, table: columnar.Table, checkpoint: Dict):
+    # the table first: if we die in between, the last chunk is just done twice
+    table_path, checkpoint_path = _shard_paths(state, shard)
+    table.save(table_path)
+    tmp = checkpoint_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(tmp, checkpoint_path)
+
+
+def _try_criterions(address: Dict) -> Optional[Dict]:
+    try:
+        return req.criterions(**address)
+    except Exception as e:
+        print(f"{address} failed: {e}", file=sys.stderr)
+        return None
+
+
+def _crawl_shard(shard: int, addresses: List[Dict], state: str, limit: RateLimit, done, failed,
+                 threads: int, chunk_size: int, max_failures: int):
+    req.throttle = limit.wait
+    table, checkpoint = _load_checkpoint(state, shard)
+    # addresses that failed last time are retried first; they stay in failed
+    # until they succeed, so stopping halfway through them loses none
+    todo = checkpoint["failed"] + list(range(checkpoint["done"], len(addresses)))
+    failed_set = set(checkpoint["failed"])
+    consecutive = 0
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            for i, details in zip(chunk, executor.map(lambda i: _try_criterions(addresses[i]), chunk)):
+                if details is None:
+                    if i not in failed_set:
+                        failed_set.add(i)
+                        checkpoint["failed"].append(i)
+                    consecutive += 1
+                else:
+                    table.append(addresses[i], details)
+                    if i in failed_set:
+                        failed_set.discard(i)
+                        checkpoint["failed"].remove(i)
+                    consecutive = 0
+                checkpoint["done"] = max(checkpoint["done"], i + 1)
+            _save_checkpoint(state, shard, table, checkpoint)
+            done[shard] = checkpoint["done"] - len(checkpoint["failed"])
+            failed[shard] = len(checkpoint["failed"])
+            if consecutive >= max_failures:
+                # most likely out of quota or the gateway is down, a rerun resumes here
+                print(f"shard {shard}: {consecutive} failures in a row, stopping", file=sys.stderr)
+                sys.exit(2)
+
+
+def consolidate(state: str, shards: int, out: str) -> columnar.Table:
+    # merges every shard (and what OUT already had) into OUT
+    table = columnar.Table.load(out, mmap=False) if os.path.exists(out) else columnar.Table()
+    for shard in range(shards):
+        table_path, _ = _shard_paths(state, shard)
+        if os.path.exists(table_path):
+            table.update(columnar.Table.load(table_path))
+    table.save(out)
+    return table
+
+
+def _format_duration(seconds: float) -> str:
+    m, s = divmod(int(seconds), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}"
+
+
+def crawl(addresses: List[Dict], out: str, state: str, shards: int = 4, rate: float = 10.0, burst: int = 10,
+          threads: int = 4, chunk_size: int = 50, max_failures: int = 20, report: float = 10.0) -> int:
+    os.makedirs(state, exist_ok=True)
+    meta_path = os.path.join(state, "crawl.json")
+    meta = dict(addresses=len(addresses), shards=shards)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            previous = json.load(f)
+        if previous != meta:
+            raise ValueError(f"{state} belongs to a crawl of {previous}, not {meta}; use another --state")
+    else:
+        with open(meta_path, "w") as f:
+            json.dump(meta, f)
+
+    # spawn, not fork: the children set up their own gateway session and cache
+    context = multiprocessing.get_context("spawn")
+    limit = RateLimit(rate, burst, context)
+    done = context.Array("q", shards)
+    failed = context.Array("q", shards)
+    for shard in range(shards):
+        checkpoint = _read_checkpoint(state, shard)
+        done[shard] = checkpoint["done"] - len(checkpoint["failed"])
+        failed[shard] = len(checkpoint["failed"])
+    processes = [
+        context.Process(target=_crawl_shard, name=f"crawl-{shard}", args=(
+            shard, addresses[shard::shards], state, limit, done, failed, threads, chunk_size, max_failures))
+        for shard in range(shards)
+    ]
+    for process in processes:
+        process.start()
+
+    start, done_at_start = time.time(), sum(done)
+    last_report = start
+    while any(process.is_alive() for process in processes):
+        time.sleep(min(report, 0.5))
+        if time.time() - last_report < report:
+            continue
+        last_report = time.time()
+        n, elapsed = sum(done), last_report - start
+        speed = (n - done_at_start) / elapsed
+        eta = _format_duration((len(addresses) - n - sum(failed)) / speed) if speed > 0 else "?"
+        print(f"{n}/{len(addresses)} addresses, {sum(failed)} failed, {speed:.1f}/s, ETA {eta}", file=sys.stderr)
+    for process in processes:
+        process.join()
+
+    table = consolidate(state, shards, out)
+    print(f"{len(table)} addresses in {out}, {sum(failed)} failed", file=sys.stderr)
+    return sum(process.exitcode != 0 for process in processes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute criteria of a CSV of addresses (City, Street, Building No., Postal Code) into a columnar dataset.")
+    parser.add_argument("addresses", help="input CSV")
+    parser.add_argument("--out", default="src/.cache/criteria.npy")
+    parser.add_argument("--state", default=None, help="checkpoint directory, OUT.shards by default")
+    parser.add_argument("--shards", type=int, default=4, help="worker processes")
+    parser.add_argument("--rate", type=float, default=10.0, help="gateway requests per second, all shards together")
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=4, help="addresses fetched at once per shard")
+    parser.add_argument("--chunk-size", type=int, default=50, help="addresses per checkpoint")
+    parser.add_argument("--max-failures", type=int, default=20, help="a shard stops after this many failures in a row")
+    parser.add_argument("--report", type=float, default=10.0, help="seconds between progress lines")
+    args = parser.parse_args()
+    stopped = crawl(list(read_addresses(args.addresses)), args.out, args.state or args.out + ".shards", shards=args.shards,
+                    rate=args.rate, burst=args.burst, threads=args.threads, chunk_size=args.chunk_size,
+                    max_failures=args.max_failures, report=args.report)
+    if stopped:
+        print(f"{stopped} shards stopped early, run again to resume", file=sys.stderr)
+        sys.exit(2)
+
+
+if __name__ == '__main__':
+    main()
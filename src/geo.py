@@ -0,0 +1,91 @@
+import math
+
+import numpy as np
+
+from typing import Tuple, Union
+
+
+# UTM (WGS84) to latitude/longitude on whole arrays at once, with a zone per
+# point if need be. The gateway gives UTM meters in the zone of the address,
+# so the zone comes from the city: see req.zone.
+
+# approximate centres, enough to tell the zone of a city
+cities = {
+    "Białystok": (53.133, 23.164),
+    "Bydgoszcz": (53.123, 18.008),
+    "Gdańsk": (54.352, 18.646),
+    "Katowice": (50.264, 19.024),
+    "Kraków": (50.065, 19.945),
+    "Lublin": (51.246, 22.568),
+    "Łódź": (51.759, 19.456),
+    "Poznań": (52.406, 16.925),
+    "Szczecin": (53.428, 14.553),
+    "Warszawa": (52.230, 21.012),
+    "Wrocław": (51.108, 17.038),
+}
+
+_K0 = 0.9996
+_R = 6378137.0
+_E = 0.00669438
+_E_P2 = _E / (1 - _E)
+_M1 = 1 - _E / 4 - 3 * _E ** 2 / 64 - 5 * _E ** 3 / 256
+_N = (1 - math.sqrt(1 - _E)) / (1 + math.sqrt(1 - _E))
+# footpoint latitude series
+_P = (
+    3 / 2 * _N - 27 / 32 * _N ** 3 + 269 / 512 * _N ** 5,
+    21 / 16 * _N ** 2 - 55 / 32 * _N ** 4,
+    151 / 96 * _N ** 3 - 417 / 128 * _N ** 5,
+    1097 / 512 * _N ** 4,
+)
+_LETTERS = "CDEFGHJKLMNPQRSTUVWXX"
+
+Zone = Union[int, np.ndarray]
+
+
+def parse_zone(zone: str) -> Tuple[int, bool]:
+    # "34U" -> (34, True); letters from N up are the northern hemisphere
+    number, letter = int(zone[:-1]), zone[-1].upper()
+    if not 1 <= number <= 60 or letter not in _LETTERS:
+        raise ValueError(f"not a UTM zone: {zone}")
+    return number, letter >= "N"
+
+
+def zone_of(lat: float, lon: float) -> str:
+    # zone containing a point, with the Norway and Svalbard exceptions
+    if not -80 <= lat <= 84:
+        raise ValueError(f"latitude {lat} is outside UTM")
+    number = int((lon + 180) // 6) % 60 + 1
+    if 56 <= lat < 64 and 3 <= lon < 12:
+        number = 32
+    elif lat >= 72 and 0 <= lon < 42:
+        number = (31, 33, 35, 37)[min(int((lon + 3) // 12), 3)]
+    return f"{number}{_LETTERS[int((lat + 80) // 8)]}"
+
+
+def to_latlon(x, y, number: Zone, northern: Union[bool, np.ndarray] = True) -> Tuple[np.ndarray, np.ndarray]:
+    # x, y: UTM eastings and northings, number (and northern) one per point or
+    # one for all; returns degrees
+    x = np.asarray(x, dtype=float) - 500000
+    y = np.asarray(y, dtype=float) - np.where(northern, 0, 10000000)
+    mu = y / (_K0 * _R * _M1)
+    p = mu + _P[0] * np.sin(2 * mu) + _P[1] * np.sin(4 * mu) + _P[2] * np.sin(6 * mu) + _P[3] * np.sin(8 * mu)
+    sin, cos = np.sin(p), np.cos(p)
+    tan = sin / cos
+    tan2 = tan * tan
+    ep = 1 - _E * sin * sin
+    c = _E_P2 * cos * cos
+    c2 = c * c
+    d = x * np.sqrt(ep) / (_R * _K0)
+    d2 = d * d
+    lat = p - tan * ep / (1 - _E) * d2 * (
+        1 / 2
+        - d2 / 24 * (5 + 3 * tan2 + 10 * c - 4 * c2 - 9 * _E_P2)
+        + d2 * d2 / 720 * (61 + 90 * tan2 + 298 * c + 45 * tan2 * tan2 - 252 * _E_P2 - 3 * c2)
+    )
+    lon = d * (
+        1
+        - d2 / 6 * (1 + 2 * tan2 + c)
+        + d2 * d2 / 120 * (5 - 2 * c + 28 * tan2 - 3 * c2 + 8 * _E_P2 + 24 * tan2 * tan2)
+    ) / cos
+    central = (np.asarray(number) - 1) * 6 - 177
+    return np.degrees(lat), (np.degrees(lon) + central + 180) % 360 - 180
@@ -0,0 +1,153 @@
+import bisect
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Tuple
+
+
+# In-process counters and latency histograms, rendered in the Prometheus text
+# format by render() and served on /metrics by serve().
+
+buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class _Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+_lock = threading.Lock()
+_counters: Dict[str, Dict[Labels, float]] = defaultdict(lambda: defaultdict(float))
+_histograms: Dict[str, Dict[Labels, _Histogram]] = defaultdict(lambda: defaultdict(_Histogram))
+# callables returning (name, labels, value) samples computed at render time
+_collectors: List[Callable[[], Iterable[Tuple[str, Dict, float]]]] = []
+_help: Dict[str, str] = {}
+
+
+def _labels(labels: Dict) -> Labels:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def describe(name: str, help: str):
+    _help[name] = help
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        _counters[name][_labels(labels)] += value
+
+
+def observe(name: str, value: float, **labels):
+    with _lock:
+        _histograms[name][_labels(labels)].observe(value)
+
+
+@contextmanager
+def timer(name: str, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def collector(fun: Callable[[], Iterable[Tuple[str, Dict, float]]]):
+    _collectors.append(fun)
+    return fun
+
+
+def _format(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+def render() -> str:
+    lines = []
+    with _lock:
+        counters = {name: dict(samples) for name, samples in _counters.items()}
+        histograms = {name: {labels: (list(h.counts), h.sum, h.count) for labels, h in samples.items()}
+                      for name, samples in _histograms.items()}
+    for fun in _collectors:
+        for name, labels, value in fun():
+            counters.setdefault(name, {})[_labels(labels)] = value
+
+    for name, samples in sorted(counters.items()):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} counter")
+        for labels, value in sorted(samples.items()):
+            lines.append(f"{name}{_format(labels)} {value}")
+    for name, samples in sorted(histograms.items()):
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (counts, total, count) in sorted(samples.items()):
+            cumulative = 0
+            for le, n in zip([*buckets, "+Inf"], counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{_format(labels + (('le', str(le)),))} {cumulative}")
+            lines.append(f"{name}_sum{_format(labels)} {total}")
+            lines.append(f"{name}_count{_format(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def snapshot() -> Dict[str, Dict[str, List[Dict]]]:
+    # one row per label set of every metric, for display
+    with _lock:
+        counters = {name: [dict(labels, value=value) for labels, value in samples.items()]
+                    for name, samples in _counters.items()}
+        histograms = {name: [dict(labels, count=h.count, mean=h.sum / h.count if h.count else 0.0)
+                             for labels, h in samples.items()]
+                      for name, samples in _histograms.items()}
+    for fun in _collectors:
+        for name, labels, value in fun():
+            counters.setdefault(name, []).append(dict(labels, value=value))
+    return dict(counters=counters, histograms=histograms)
+
+
+def dump(path: str):
+    with open(path, "w") as f:
+        f.write(render())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+_server = None
+
+
+def serve(port: int) -> ThreadingHTTPServer:
+    # idempotent, streamlit reruns the app script on every interaction
+    global _server
+    with _lock:
+        if _server is None:
+            _server = ThreadingHTTPServer(("0.0.0.0", port), _Handler)
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, daemon=True).start()
+        return _server
@@ -0,0 +1,186 @@
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Optional
+
+from src import cache
+
+
+# Stand-in for the BIK gateway: answers every endpoint used by src.req from
+# recorded responses (the sqlite response store) or with synthetic values that
+# are deterministic per payload. Point src.req at it with
+#
+#   HOMEAWARE_GATEWAY=http://localhost:8088/ streamlit run src/app.py
+
+
+def _rng(endpoint: str, payload: Any) -> random.Random:
+    return random.Random(cache.key(endpoint, payload))
+
+
+def _location(payload: Dict) -> Dict:
+    # nearby building numbers of a street end up next to each other (and in
+    # the same grid cells), streets are spread over Łódź in UTM zone 34
+    address = payload.get("address", payload)
+    street = _rng("street", [address.get("city"), address.get("street")])
+    number = int(str(address.get("buildingNumber", address.get("building_number", 0))) or 0)
+    return dict(
+        utm_x=round(street.uniform(380000, 405000) + 7 * number, 2),
+        utm_y=round(street.uniform(5725000, 5745000) + 3 * number, 2),
+    )
+
+
+def _safety(r: random.Random, payload: Dict) -> Any:
+    return [{"details": [
+        {"category": "price", "details": {"offer_price": r.randint(4000, 12000)}},
+        {"category": "crime", "details": {k: r.randint(0, 10) for k in ["theft", "burglary", "assault", "other"]}},
+        {"category": "road_accident", "details": {"hitting_a_pedestrian": r.randint(0, 8)}},
+    ]}]
+
+
+def _nearest_poi(r: random.Random, payload: Dict) -> Any:
+    return {"nearestPOI": {payload["nearestPOI"]: round(r.uniform(50, 8000), 1)}}
+
+
+def _number_poi(r: random.Random, payload: Dict) -> Any:
+    return {"poinumber": {payload["poinumber"]: r.randint(0, 4)}}
+
+
+def _demographic(r: random.Random, payload: Dict) -> Any:
+    return {"demographicData": {payload["demographicData"]: r.randint(0, 60)}}
+
+
+def _wealth(r: random.Random, payload: Dict) -> Any:
+    return {"wealth": {"WK_RAZEM": r.randint(50000, 400000)}}
+
+
+def _geoscore(r: random.Random, payload: Dict) -> Any:
+    return {"score": str(r.randint(0, 100))}
+
+
+def _geostats(r: random.Random, payload: Dict) -> Any:
+    return {"geostats": [{"result": str(r.randint(0, 100)), "inputDataCoordinates": _location(payload)}]}
+
+
+def _address_point(r: random.Random, payload: Dict) -> Any:
+    return {"addressPoint": {payload["addressPoint"]: str(round(r.uniform(100, 20000)))}}
+
+
+def _area_statistic(r: random.Random, payload: Dict) -> Any:
+    return {"areaStatistic": {payload["areaStatistic"]: str(r.randint(0, 30))}}
+
+
+def _behaviour(r: random.Random, payload: Dict) -> Any:
+    return {"value": f"{r.uniform(0, 40):.1f}%"}
+
+
+synthetic: Dict[str, Callable[[random.Random, Dict], Any]] = {
+    "bik-api-3/bezpieczenstwo-adres": _safety,
+    "bik-api-4/punkty-zainteresowania-adres": _nearest_poi,
+    "bik-api-4/liczba-poi-adres": _number_poi,
+    "bik-api-4/dane-demograficzne-adres": _demographic,
+    "bik-api-4/zamoznosc-adres": _wealth,
+    "bik-api-5/geoscore-adres": _geoscore,
+    "bik-api-6/address": _geostats,
+    "bik-api-10/odleglosc-punkt-adres": _address_point,
+    "bik-api-10/charakterystyka-obszaru-adres": _area_statistic,
+    "bik-api-11/zachowania-wg-adresu": _behaviour,
+}
+
+
+class Gateway(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0,
+                 error_status: int = 500, recorded: Optional[str] = None, seed: int = 0):
+        super().__init__(address, _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.recorded = cache.Store(recorded, max_bytes=2**62) if recorded else None
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.counts = Counter()
+        self.counts_lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/"
+
+    def respond(self, endpoint: str, payload: Any) -> Any:
+        if self.recorded is not None:
+            recorded = self.recorded.get(cache.key(endpoint, payload))
+            if recorded is not None:
+                return recorded
+        return synthetic[endpoint](_rng(endpoint, payload), payload)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: Gateway
+    # keep-alive like the real gateway, so pooled connections get reused
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: Any):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        # request counts per endpoint, handy to check how many calls a change saves
+        with self.server.counts_lock:
+            self._send(200, dict(self.server.counts))
+
+    def do_POST(self):
+        endpoint = self.path.lstrip("/")
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or "null")
+        with self.server.counts_lock:
+            self.server.counts[endpoint] += 1
+        with self.server.random_lock:
+            delay = self.server.latency + self.server.random.uniform(0, self.server.jitter)
+            fail = self.server.random.random() < self.server.error_rate
+        time.sleep(delay)
+        if endpoint not in synthetic:
+            return self._send(404, {"error": f"unknown endpoint {endpoint}"})
+        if fail:
+            return self._send(self.server.error_status, {"error": "injected error"})
+        self._send(200, self.server.respond(endpoint, payload))
+
+
+def serve(port: int = 0, **kwargs) -> Gateway:
+    # start in a background thread, port 0 picks a free one (see Gateway.url)
+    server = Gateway(("127.0.0.1", port), **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the BIK gateway.")
+    parser.add_argument("--port", type=int, default=8088)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds added to every response")
+    parser.add_argument("--jitter", type=float, default=0.05, help="up to this many extra seconds")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--recorded", default=None, help="response store to replay, e.g. src/.cache/responses.sqlite")
+    args = parser.parse_args()
+    if args.recorded and not os.path.exists(args.recorded):
+        parser.error(f"{args.recorded} does not exist")
+    server = Gateway(("127.0.0.1", args.port), latency=args.latency, jitter=args.jitter,
+                     error_rate=args.error_rate, error_status=args.error_status, recorded=args.recorded)
+    print(f"serving on {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
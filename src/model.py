@@ -1,7 +1,6 @@
-import pandas as pd
 import numpy as np
 
-from typing import Dict
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 
 default_thresholds = dict(
@@ -34,6 +33,77 @@ default_thresholds = dict(
 )
 
 
+coarse_criteria = {
+    'Education': [ 'education', 'university' ],
+    'Safety': ['car_collisions', 'consumer_expenses', 'cr3', 'crimes', 'geoscore'],
+    'Transport': ['garages', 'tram_stop', 'bus_stop', 'railway_station'],
+    'Services': ['parcel_lockers', 'post_office', 'health', 'culture_entertainment', 'mall'],
+    'Extraversion': ['between_20_30', 'dating_apps'],
+    'Community': ['over_60', 'sport', 'worship'],
+    'Nature': ['nature'],
+    'Comfort': ['airport', 'civil_services', 'railway_tracks', 'freeways'],       
+}
+
+
+class Transform(NamedTuple):
+    # utility = sign * f(variant[source] / unit, thresh[threshold]) where f is
+    #   norm:   clip(x, 0, t) / t
+    #   clip:   clip(x, 0, t)
+    #   linear: x
+    source: str
+    unit: float
+    threshold: Optional[str]
+    kind: str = 'norm'
+    sign: int = 1
+
+
+transforms = dict(
+    between_20_30=Transform('between_20_30', 1, 'between_20_30'),
+    bus_stop=Transform('bus_stop', 1000, 'bus_stop'),
+    car_collisions=Transform('car_collisions', 1, 'car_collisions'),
+    cr3=Transform('cr3', 100, None, 'linear'),
+    crimes=Transform('crimes', 1, 'crimes'),
+    consumer_expenses=Transform('consumer_expenses', 1, 'consumer_expenses'),
+    culture_entertainment=Transform('culture_entertainment', 1000, 'culture_entertainment'),
+    health=Transform('health', 1000, 'health'),
+    dating_apps=Transform('dating_apps', 100 / 20, 'dating_apps', 'clip'),
+    education=Transform('education', 1, 'education'),
+    garages=Transform('garages', 1, 'garages'),
+    geoscore=Transform('geoscore', 100, None, 'linear'),
+    mall=Transform('mall', 1000, 'mall'),
+    nature=Transform('nature', 1, 'nature'),
+    over_60=Transform('over_60', 1, 'over_60'),
+    parcel_lockers=Transform('parcel_lockers', 1000, 'nature'),
+    post_office=Transform('post_office', 1000, 'post_office'),
+    railway_station=Transform('railway_station', 1000, 'railway_station'),
+    civil_services=Transform('civil_services', 1000, 'civil_services', sign=-1),
+    railway_tracks=Transform('railway_tracks', 1000, 'railway_tracks', sign=-1),
+    freeways=Transform('freeways', 1000, 'freeways', sign=-1),
+    airport=Transform('airports', 1000, 'airport', sign=-1),
+    sport=Transform('sport', 100, None, 'linear'),
+    tram_stop=Transform('tram_stop', 1000, 'tram_stop'),
+    university=Transform('university', 1000, 'university'),
+    worship=Transform('worship', 1000, 'worship'),
+)
+
+# column order of the batched arrays
+fine_criteria = list(transforms)
+coarse_groups = list(coarse_criteria)
+# the criterions() result each column is computed from
+fine_sources = [t.source for t in transforms.values()]
+
+_units = np.array([t.unit for t in transforms.values()], dtype=float)
+_signs = np.array([t.sign for t in transforms.values()], dtype=float)
+_is_norm = np.array([t.kind == 'norm' for t in transforms.values()])
+_is_linear = np.array([t.kind == 'linear' for t in transforms.values()])
+
+
+def coarse_profiles(path: str = 'src/presets_coarse.csv') -> Dict[str, Dict[str, float]]:
+    # profile name -> coarse group -> weight
+    import pandas as pd  # only needed here, keeps scoring imports light
+    return pd.read_csv(path, index_col='name').to_dict()
+
+
 def clip(x, mini, maxi):
     return max(min(x, maxi), mini)
 
@@ -72,6 +142,205 @@ def partial_utilities(thresh: Dict, variant: Dict) -> Dict:
     )
 
 
+def required_criteria(weights: Dict) -> List[str]:
+    # criterions() results that can change the score, i.e. those of groups
+    # with a non-zero weight
+    return sorted({
+        transforms[fine].source
+        for group, fine_criteria in coarse_criteria.items() if weights[group]
+        for fine in fine_criteria
+    })
+
+
+def criteria_matrix(variants: List[Dict]) -> np.ndarray:
+    # N variants x C fine criteria of raw criterion values, NaN where missing
+    return np.array([[variant.get(source, np.nan) for source in fine_sources] for variant in variants], dtype=float).reshape(-1, len(fine_sources))
+
+
+def threshold_vector(thresh: Dict) -> np.ndarray:
+    return np.array([thresh[t.threshold] if t.threshold else np.nan for t in transforms.values()], dtype=float)
+
+
+def coarse_matrix() -> np.ndarray:
+    # C fine x G coarse, averages the fine utilities of each group
+    M = np.zeros((len(fine_criteria), len(coarse_groups)))
+    for g, group in enumerate(coarse_groups):
+        for fine in coarse_criteria[group]:
+            M[fine_criteria.index(fine), g] = 1 / len(coarse_criteria[group])
+    return M
+
+
+_coarse_matrix = coarse_matrix()
+
+
+def batch_partial_utilities(X: np.ndarray, thresholds: np.ndarray, columns=slice(None)) -> np.ndarray:
+    # same as partial_utilities for every row of X at once, optionally only
+    # for some columns (criteria)
+    thresholds = thresholds[columns]
+    x = X[:, columns] / _units[columns]
+    # clip the way clip() does, also for negative thresholds
+    clipped = np.maximum(np.minimum(x, thresholds), 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        normed = np.where(thresholds == 0, 0, clipped / thresholds)
+    U = np.where(_is_linear[columns], x, np.where(_is_norm[columns], normed, clipped))
+    return _signs[columns] * U
+
+
+def batch_coarse_means(fine: np.ndarray, groups=slice(None)) -> np.ndarray:
+    # N x G unweighted mean utility of each group, NaN if a criterion is missing
+    M = _coarse_matrix[:, groups]
+    missing = np.isnan(fine)
+    means = np.where(missing, 0, fine) @ M
+    means[(missing @ (M > 0)) > 0] = np.nan
+    return means
+
+
+def batch_weigh(means: np.ndarray, weights: Dict) -> np.ndarray:
+    # groups with zero weight count as 0 even if their criteria were not fetched
+    w = np.array([weights[group] for group in coarse_groups], dtype=float)
+    coarse = means * (w / sum(weights.values()))
+    coarse[:, w == 0] = 0
+    return coarse
+
+
+def batch_coarse_utilities(fine: np.ndarray, weights: Dict) -> np.ndarray:
+    # N x G weighted coarse utilities, each row sums to the match score
+    return batch_weigh(batch_coarse_means(fine), weights)
+
+
+def score(variants: List[Dict], thresh: Dict, weights: Dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    return score_matrix(criteria_matrix(variants), thresh, weights)
+
+
+def score_matrix(X: np.ndarray, thresh: Dict, weights: Dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # score() of a criteria_matrix(), e.g. columnar.Table.matrix(fine_sources)
+    fine = batch_partial_utilities(X, threshold_vector(thresh))
+    coarse = batch_coarse_utilities(fine, weights)
+    return fine, coarse, coarse.sum(axis=1)
+
+
+def utility_bounds(thresh: Dict, X: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    # lowest and highest fine utility of each column under these thresholds.
+    # 'linear' columns are not clipped, their unit scales a 0-100 score to
+    # [0, 1]; with raw values X (e.g. a whole dataset) the bounds also cover
+    # whatever those reach
+    t = threshold_vector(thresh)
+    lo = np.zeros(len(fine_criteria))
+    hi = np.where(_is_linear, 1.0, np.where(_is_norm, (t > 0).astype(float), np.maximum(np.nan_to_num(t), 0)))
+    bounds = np.where(_signs < 0, -hi, lo), np.where(_signs < 0, -lo, hi)
+    return bounds if X is None else widen_bounds(bounds, batch_partial_utilities(X, t))
+
+
+def widen_bounds(bounds: Tuple[np.ndarray, np.ndarray], fine: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # bounds that also hold for every known (not NaN) fine utility
+    lo, hi = bounds
+    if not len(fine):
+        return lo, hi
+    return np.minimum(lo, np.where(np.isnan(fine), lo, fine).min(axis=0)), np.maximum(hi, np.where(np.isnan(fine), hi, fine).max(axis=0))
+
+
+def score_bounds(fine: np.ndarray, bounds: Tuple[np.ndarray, np.ndarray], weights: Dict) -> Tuple[np.ndarray, np.ndarray]:
+    # N lowest and highest scores still possible when the NaN fine utilities
+    # are unknown; scores grow with every fine utility
+    lo, hi = bounds
+    missing = np.isnan(fine)
+    lower = batch_coarse_utilities(np.where(missing, lo, fine), weights).sum(axis=1)
+    upper = batch_coarse_utilities(np.where(missing, hi, fine), weights).sum(axis=1)
+    return lower, upper
+
+
+class IncrementalScorer:
+    # score() for a UI that rescores the same variants on every rerun. Raw
+    # values, fine utilities and group means are kept per variant key; when a
+    # threshold changes only its criterion and group are recomputed, when only
+    # the weights change the group means are just reweighed
+
+    def __init__(self):
+        self._keys = []
+        self._X = np.zeros((0, len(fine_criteria)))
+        self._fine = np.zeros((0, len(fine_criteria)))
+        self._means = np.zeros((0, len(coarse_groups)))
+        self._thresholds = np.full(len(fine_criteria), np.nan)
+
+    def score(self, keys: List, variants: List[Dict], thresh: Dict, weights: Dict) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # keys identify variants, a key must change whenever its values do
+        t = threshold_vector(thresh)
+        if keys != self._keys:
+            self._reindex(keys, variants)
+        changed = ~((self._thresholds == t) | (np.isnan(self._thresholds) & np.isnan(t)))
+        if changed.any():
+            self._fine[:, changed] = batch_partial_utilities(self._X, t, changed)
+            groups = (_coarse_matrix[changed] > 0).any(axis=0)
+            self._means[:, groups] = batch_coarse_means(self._fine, groups)
+            self._thresholds = t
+        coarse = batch_weigh(self._means, weights)
+        return self._fine.copy(), coarse, coarse.sum(axis=1)
+
+    def means(self) -> np.ndarray:
+        # N x G unweighted group means of the last scored variants
+        return self._means.copy()
+
+    def _reindex(self, keys: List, variants: List[Dict]):
+        old = {k: i for i, k in enumerate(self._keys)}
+        kept = [i for i, k in enumerate(keys) if k in old]
+        new = [i for i, k in enumerate(keys) if k not in old]
+        X = np.zeros((len(keys), len(fine_criteria)))
+        fine = np.zeros_like(X)
+        means = np.zeros((len(keys), len(coarse_groups)))
+        rows = [old[keys[i]] for i in kept]
+        X[kept], fine[kept], means[kept] = self._X[rows], self._fine[rows], self._means[rows]
+        if new:
+            # computed with the old thresholds so every row is in the same state
+            X[new] = criteria_matrix([variants[i] for i in new])
+            fine[new] = batch_partial_utilities(X[new], self._thresholds)
+            means[new] = batch_coarse_means(fine[new])
+        self._keys, self._X, self._fine, self._means = list(keys), X, fine, means
+
+
+def sample_weights(weights: Dict, n: int, spread: float = 0.1, method: str = 'dirichlet',
+                   rng: Optional[np.random.Generator] = None) -> np.ndarray:
+    # n x G normalized weight vectors around weights; 'uniform' scales each
+    # weight by up to +-spread, 'dirichlet' draws around the normalized weights
+    # so that a weight of average size varies by about spread (relative
+    # standard deviation). Zero weights stay zero
+    rng = rng or np.random.default_rng()
+    w = np.array([weights[group] for group in coarse_groups], dtype=float)
+    w = w / w.sum()
+    if method == 'uniform':
+        W = w * rng.uniform(1 - spread, 1 + spread, (n, len(w)))
+    elif method == 'dirichlet':
+        k = int((w > 0).sum())
+        concentration = max(k - 1, 1) / spread ** 2
+        W = np.zeros((n, len(w)))
+        W[:, w > 0] = rng.standard_gamma(w[w > 0] * concentration, (n, k))
+    else:
+        raise ValueError(f"unknown method {method}")
+    return (W / W.sum(axis=1, keepdims=True)).astype(np.float32)
+
+
+def rank_stability(means: np.ndarray, weights: Dict, samples: int = 10000, spread: float = 0.1,
+                   method: str = 'dirichlet', top: Optional[int] = None, chunk: int = 1000,
+                   seed: Optional[int] = 0) -> np.ndarray:
+    # N x top: fraction of sampled weight vectors under which each location
+    # (row of the N x G group means, see IncrementalScorer.means) ranks 1st,
+    # 2nd, ... Scores of a chunk of samples are one float32 matrix product;
+    # only the best `top` of every sample are sorted
+    rng = np.random.default_rng(seed)
+    n = len(means)
+    top = min(top or n, n)
+    M = np.nan_to_num(means).astype(np.float32)
+    counts = np.zeros(n * top, dtype=np.int64)
+    ranks = np.arange(top)[:, None]
+    for start in range(0, samples, chunk):
+        W = sample_weights(weights, min(chunk, samples - start), spread, method, rng)
+        scores = M @ W.T
+        best = np.argpartition(-scores, top - 1, axis=0)[:top] if top < n else np.tile(np.arange(n)[:, None], (1, len(W)))
+        order = np.argsort(-np.take_along_axis(scores, best, axis=0), axis=0)
+        at_rank = np.take_along_axis(best, order, axis=0)
+        counts += np.bincount((at_rank * top + ranks).ravel(), minlength=n * top)
+    return counts.reshape(n, top) / samples
+
+
 def global_utility(params: dict, variant: dict):
     U = partial_utilities(params, variant)
     return np.sum(list(U.values()))/np.sum(list(params.values()))
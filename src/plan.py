@@ -0,0 +1,124 @@
+import time
+
+from collections import Counter, defaultdict
+from concurrent.futures import Executor, as_completed
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from src import cache
+
+
+def _single(value: Any) -> Any:
+    return value
+
+
+class Call(NamedTuple):
+    # one gateway request; extract picks the part of the response a criterion
+    # uses. Area-level statistics set grid to the cell size (in meters) they
+    # are aggregated over, along with the address they are requested for
+    endpoint: str
+    payload: Dict
+    extract: Callable[[Any], Any] = _single
+    grid: int = 0
+    address: Optional[Dict] = None
+
+    @property
+    def key(self) -> str:
+        return cache.key(self.endpoint, self.payload)
+
+
+class Need(NamedTuple):
+    # what a criterion needs for one address: the calls, and how to reduce
+    # their extracted values (in the same order) into the criterion value
+    calls: List[Call]
+    reduce: Callable[..., Any] = _single
+
+
+class Plan:
+    # every call needed to evaluate some criteria for some addresses, with
+    # identical (endpoint, payload) pairs fetched only once
+
+    def __init__(self, addresses: Iterable[Dict], criteria: List[Callable[[Dict], Need]]):
+        self.addresses = list(addresses)
+        self.needs = [{criterion.__name__: criterion(address) for criterion in criteria} for address in self.addresses]
+        self.calls = {}
+        self.keys = []
+        self.elapsed = {}
+        for needs in self.needs:
+            keys = {}
+            for name, need in needs.items():
+                keys[name] = [call.key for call in need.calls]
+                for k, call in zip(keys[name], need.calls):
+                    self.calls.setdefault(k, call)
+            self.keys.append(keys)
+
+    def __len__(self) -> int:
+        return len(self.calls)
+
+    def requested(self) -> int:
+        # number of calls before deduplication
+        return sum(len(keys) for address_keys in self.keys for keys in address_keys.values())
+
+    def endpoints(self) -> Counter:
+        return Counter(call.endpoint for call in self.calls.values())
+
+    def fetch(self, fetch: Callable[[Call], Any], executor: Executor) -> Dict[str, Any]:
+        start = time.perf_counter()
+
+        def timed(call: Call) -> Tuple[Any, float]:
+            value = fetch(call)
+            return value, time.perf_counter() - start
+        results = list(executor.map(timed, self.calls.values()))
+        # seconds from the start of the fetch until each call resolved
+        self.elapsed = {k: seconds for k, (_, seconds) in zip(self.calls, results)}
+        return {k: value for k, (value, _) in zip(self.calls, results)}
+
+    def criterion_seconds(self) -> List[Dict[str, float]]:
+        # per address, seconds until the last call of each criterion resolved
+        return [
+            {name: max((self.elapsed[k] for k in keys), default=0.0) for name, keys in address_keys.items()}
+            for address_keys in self.keys
+        ]
+
+    def reduce(self, responses: Dict[str, Any]) -> List[Dict]:
+        results = []
+        for needs, keys in zip(self.needs, self.keys):
+            results.append({
+                name: need.reduce(*[call.extract(responses[k]) for k, call in zip(keys[name], need.calls)])
+                for name, need in needs.items()
+            })
+        return results
+
+    def run(self, fetch: Callable[[Call], Any], executor: Executor) -> List[Dict]:
+        return self.reduce(self.fetch(fetch, executor))
+
+    def stream(self, fetch: Callable[[Call], Any], executor: Executor,
+               first: Iterable[str] = ()) -> Iterator[Tuple[int, str, Any]]:
+        # yields (address index, criterion, value) as soon as the last call of
+        # a criterion resolves; calls of the criteria in `first` are sent first
+        first = set(first)
+        waiting = defaultdict(list)
+        remaining = {}
+        for i, address_keys in enumerate(self.keys):
+            for name, keys in address_keys.items():
+                remaining[i, name] = len(set(keys))
+                for k in set(keys):
+                    waiting[k].append((i, name))
+                if not keys:
+                    yield i, name, self.needs[i][name].reduce()
+        order = sorted(self.calls, key=lambda k: not any(name in first for _, name in waiting[k]))
+        futures = {executor.submit(fetch, self.calls[k]): k for k in order}
+        responses = {}
+        try:
+            for future in as_completed(futures):
+                k = futures[future]
+                responses[k] = future.result()
+                for i, name in waiting[k]:
+                    remaining[i, name] -= 1
+                    if remaining[i, name] == 0:
+                        need = self.needs[i][name]
+                        yield i, name, need.reduce(*[
+                            call.extract(responses[key]) for key, call in zip(self.keys[i][name], need.calls)
+                        ])
+        finally:
+            for future in futures:
+                future.cancel()
@@ -0,0 +1,74 @@
+import numpy as np
+
+from typing import Dict, List, Optional, Tuple
+
+from src.model import batch_coarse_means, batch_partial_utilities, coarse_groups, criteria_matrix, threshold_vector
+
+
+# Learns coarse weights from "a is better than b" judgements. The match score
+# is w . m(x), with m(x) the unweighted group means of a location and w the
+# weights normalized to sum to 1, so every pair asks for w . (m(a) - m(b)) > 0.
+# We look for the weights closest to the user's profile that satisfy the pairs
+# with a margin:
+#
+#   min  strength / 2 * |w - w0|^2 + 1 / P * sum_p max(0, margin - w . d_p)^2
+#   s.t. w >= 0, sum(w) = 1
+#
+# solved with projected gradient descent. Adding a pair moves the optimum only
+# a little, so starting from the previous weights converges in a few steps.
+
+
+def project_simplex(v: np.ndarray) -> np.ndarray:
+    # closest point of {w >= 0, sum(w) = 1} (Duchi et al. 2008)
+    u = np.sort(v)[::-1]
+    css = np.cumsum(u) - 1
+    rho = np.nonzero(u > css / np.arange(1, len(v) + 1))[0][-1]
+    return np.maximum(v - css[rho] / (rho + 1), 0)
+
+
+def fit(D: np.ndarray, w0: np.ndarray, w: Optional[np.ndarray] = None, strength: float = 0.05,
+        margin: float = 0.05, iterations: int = 1000, tol: float = 1e-7) -> Tuple[np.ndarray, int]:
+    # D is P pairs x G groups of m(better) - m(worse); returns the weights and
+    # the number of iterations it took
+    w = w0.copy() if w is None else w.copy()
+    P = max(len(D), 1)
+    # the gradient is Lipschitz with at most this constant
+    step = 1 / (strength + 2 / P * np.sum(D ** 2))
+    for i in range(1, iterations + 1):
+        slack = np.maximum(margin - D @ w, 0)
+        gradient = strength * (w - w0) - 2 / P * slack @ D
+        new = project_simplex(w - step * gradient)
+        if np.abs(new - w).max() < tol:
+            return new, i
+        w = new
+    return w, iterations
+
+
+def group_means(variants: List[Dict], thresh: Dict) -> np.ndarray:
+    # N x G unweighted group utilities; groups with a missing criterion are 0
+    fine = batch_partial_utilities(criteria_matrix(variants), threshold_vector(thresh))
+    return np.nan_to_num(batch_coarse_means(fine))
+
+
+class PreferenceModel:
+    # keeps the last solution, every update() starts from it
+
+    def __init__(self, strength: float = 0.05, margin: float = 0.05):
+        self.strength = strength
+        self.margin = margin
+        self.w = None
+        self.iterations = 0
+        self.violated = 0
+
+    def update(self, pairs: List[Tuple[str, str]], means: Dict[str, np.ndarray], prior: Dict[str, float]) -> Dict[str, float]:
+        # pairs of (better, worse) location names, means of every named
+        # location, prior weights of the profile; returns adjusted weights on
+        # the scale of the prior
+        total = sum(prior.values()) or 1.0
+        w0 = np.array([prior[group] for group in coarse_groups], dtype=float) / total
+        if not w0.any():
+            w0[:] = 1 / len(w0)
+        D = np.array([means[better] - means[worse] for better, worse in pairs]).reshape(-1, len(coarse_groups))
+        self.w, self.iterations = fit(D, w0, self.w, self.strength, self.margin)
+        self.violated = int(np.sum(D @ self.w <= 0))
+        return {group: float(w * total) for group, w in zip(coarse_groups, self.w)}
@@ -0,0 +1,95 @@
+import argparse
+import csv
+import queue
+import sys
+import threading
+import time
+
+from typing import Dict, Iterable, Optional, Tuple
+
+from src.req import address_of, criterions
+
+
+# Background warm-up of the response cache. The app enqueues every location as
+# soon as it is added, so criteria are usually cached by the time a page needs
+# them; python -m src.prefetch warms the cache for a whole address list.
+
+_queue = queue.Queue()
+_pending = set()
+_pending_lock = threading.Lock()
+_workers = []
+_workers_lock = threading.Lock()
+
+
+def _key(address: Dict, only: Optional[Tuple[str, ...]]) -> tuple:
+    return tuple(sorted(address.items())), only
+
+
+def _work():
+    while True:
+        address, only = _queue.get()
+        try:
+            criterions(**address, only=only)
+        except Exception as e:
+            print(f"prefetch of {address} failed: {e}", file=sys.stderr)
+        finally:
+            with _pending_lock:
+                _pending.discard(_key(address, only))
+            _queue.task_done()
+
+
+def start(workers: int = 2):
+    with _workers_lock:
+        while len(_workers) < workers:
+            thread = threading.Thread(target=_work, daemon=True, name=f"prefetch-{len(_workers)}")
+            thread.start()
+            _workers.append(thread)
+
+
+def enqueue(address: Dict, only: Optional[Tuple[str, ...]] = None):
+    # fire and forget; criterions() coalesces with any request the UI makes meanwhile
+    start()
+    with _pending_lock:
+        if _key(address, only) in _pending:
+            return
+        _pending.add(_key(address, only))
+    _queue.put((address, only))
+
+
+def warm(addresses: Iterable[Dict], rate: float, workers: int = 4) -> int:
+    # enqueue at most `rate` addresses per second, then wait for all of them
+    start(workers)
+    n = 0
+    started = time.time()
+    for n, address in enumerate(addresses, start=1):
+        delay = started + (n - 1) / rate - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        enqueue(address)
+        if n % 100 == 0:
+            print(f"{n} addresses queued, {_queue.qsize()} waiting", file=sys.stderr)
+    _queue.join()
+    return n
+
+
+def read_addresses(path: str) -> Iterable[Dict]:
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            try:
+                yield address_of(row)
+            except (KeyError, ValueError):
+                print(f"skipping {row}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompute criteria for a CSV of addresses (City, Street, Building No., Postal Code).")
+    parser.add_argument("addresses", help="input CSV")
+    parser.add_argument("--rate", type=float, default=1.0, help="addresses started per second")
+    parser.add_argument("--workers", type=int, default=4, help="addresses fetched at once")
+    args = parser.parse_args()
+    n = warm(read_addresses(args.addresses), rate=args.rate, workers=args.workers)
+    print(f"{n} addresses warmed", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import argparse
+import csv
+import heapq
+import os
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, List, Optional, Tuple
+
+from src.model import coarse_profiles, default_thresholds, required_criteria, score
+from src.req import address_of, criterions
+
+
+def _try_details(row: Dict, only: Tuple[str, ...]) -> Optional[Dict]:
+    try:
+        return criterions(**address_of(row), only=only)
+    except Exception as e:
+        print(f"skipping {row}: {e}", file=sys.stderr)
+        return None
+
+
+def _push(heap: List, k: int, index: int, row: Dict):
+    # min-heap of the k best rows, earlier rows win ties
+    if row['MatchScore'] == '':
+        return
+    item = (float(row['MatchScore']), -index, row)
+    if len(heap) < k:
+        heapq.heappush(heap, item)
+    elif item[:2] > heap[0][:2]:
+        heapq.heapreplace(heap, item)
+
+
+def _drop_partial_row(path: str):
+    # a run killed mid-write can leave the last row cut short; rows are
+    # written whole lines at a time, so cut the file back to its last newline
+    with open(path, 'rb+') as f:
+        data = f.read()
+        if data and not data.endswith(b'\n'):
+            f.truncate(data.rfind(b'\n') + 1)
+
+
+def _write_ranking(heap: List, fieldnames: List[str], path: str):
+    # replace the whole (small) file at once so it is never half written
+    tmp = path + '.tmp'
+    with open(tmp, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['Rank'] + fieldnames)
+        writer.writeheader()
+        for rank, (_, _, row) in enumerate(sorted(heap, key=lambda x: x[:2], reverse=True), start=1):
+            writer.writerow(dict(row, Rank=rank))
+    os.replace(tmp, path)
+
+
+def rank(addresses: str, profile: str, out: str, k: int = 10, workers: int = 4, chunk_size: int = 64):
+    weights = coarse_profiles()[profile]
+    # criteria of groups the profile ignores are never fetched
+    only = tuple(required_criteria(weights))
+    # every scored address is appended here in input order, its length is
+    # where we resume from
+    scores_path = out + '.scores.csv'
+    heap, done = [], 0
+    if os.path.exists(scores_path):
+        _drop_partial_row(scores_path)
+        with open(scores_path, newline='') as f:
+            for row in csv.DictReader(f):
+                _push(heap, k, done, row)
+                done += 1
+
+    start = time.time()
+    with open(addresses, newline='') as f, open(scores_path, 'a', newline='') as scores_file, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames + ['MatchScore']
+        writer = csv.DictWriter(scores_file, fieldnames=fieldnames)
+        if scores_file.tell() == 0:
+            writer.writeheader()
+        if done:
+            print(f"resuming after {done} addresses", file=sys.stderr)
+
+        rows = islice(reader, done, None)
+        for chunk in iter(lambda: list(islice(rows, chunk_size)), []):
+            chunk_details = list(executor.map(lambda row: _try_details(row, only), chunk))
+            found = [i for i, d in enumerate(chunk_details) if d is not None]
+            _, _, scores = score([chunk_details[i] for i in found], default_thresholds, weights)
+            for row in chunk:
+                row['MatchScore'] = ''
+            for i, s in zip(found, scores):
+                chunk[i]['MatchScore'] = s
+            for row in chunk:
+                writer.writerow(row)
+                _push(heap, k, done, row)
+                done += 1
+            scores_file.flush()
+            _write_ranking(heap, fieldnames, out)
+            print(f"{done} addresses ranked ({done / (time.time() - start):.1f}/s)", file=sys.stderr)
+
+    _write_ranking(heap, fieldnames, out)
+
+
+def main():
+    profiles = coarse_profiles()
+    parser = argparse.ArgumentParser(description="Rank addresses from a CSV (City, Street, Building No., Postal Code) against a profile.")
+    parser.add_argument("addresses", help="input CSV")
+    parser.add_argument("--profile", default="Student", choices=list(profiles))
+    parser.add_argument("--out", default="ranking.csv", help="top-k ranking CSV, all scores go to OUT.scores.csv")
+    parser.add_argument("-k", "--top", type=int, default=10)
+    parser.add_argument("--workers", type=int, default=4, help="addresses fetched at once")
+    parser.add_argument("--chunk-size", type=int, default=64)
+    args = parser.parse_args()
+    rank(args.addresses, args.profile, args.out, k=args.top, workers=args.workers, chunk_size=args.chunk_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,79 +1,359 @@
-import requests
 import json
 import os
+import re
+import threading
+import time
 import warnings
 import urllib3
-import utm
 
 from collections import defaultdict
-from deepdiff import DeepHash
-from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor
 from urllib.parse import urljoin
-from typing import Tuple, Dict
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
-with open("src/connection.json", "r") as fp:
-    _config = json.loads(fp.read())
-
-_cache_debug = False
-_cache_dict = defaultdict(dict)
-_cache_dir = _config.get("cache_dir", "src/.cache")
-if not os.path.exists(_cache_dir):
-    os.mkdir(_cache_dir)
+from requests import RequestException
 
+from src import cache, geo, metrics, transport
+from src.plan import Call, Need, Plan
+from src.resilience import CircuitBreaker, GatewayError, TokenBucket, backoff
 
-def _payload_hash(payload: str) -> str:
-    return str(DeepHash(payload)[payload])
-    
-
-def _api(endpoint: str, payload: dict, base: str = "https://gateway.oapi.bik.pl/") -> str:
-    # if endpoint + payload is cached in a file, read and return it
-
-    payload_str = json.dumps(payload)
-    cache_file = os.path.join(_cache_dir, f"{endpoint}=={_payload_hash(payload_str)}.json")
-    if _cache_debug: print('CHECK FOR CACHE', cache_file)
-    if cache_file in _cache_dict:
-        # level 1 cache
-        if _cache_debug: print('L1 CACHE', cache_file)
-        return _cache_dict[endpoint][payload_str]
-    elif os.path.exists(cache_file):
-        # level 2 cache
-        with open(cache_file, "r") as f:
-            for line in f.read().split('\n'):
-                if not line: continue
-                try:
-                    data = json.loads(line)
-                except:
-                    raise Exception('Error reading JSON: ', line)
-                inp, out = data["input"], data["output"]
-                if payload == inp:
-                    if _cache_debug: print('L2 CACHE', cache_file)
-                    _cache_dict[endpoint][payload_str] = out
-                    return out
-
-    if _cache_debug: print('FETCH', endpoint)
-    response = requests.request("POST", urljoin(base, endpoint),
-        headers={
-            "BIK-OAPI-Key": _config["BIK-OAPI-Key"],
-            "Content-Type": "application/json"
-        },
-        data=payload_str,
-        cert=(_config["cert-crt"], _config["cert-key"]),
-        verify=False
-    )
-    assert response.status_code == 200, f"API Error ({response.status_code}) ¯\_(ツ)_/¯"
-    data = response.json()
-
-    _cache_dict[endpoint][payload_str] = data
-    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
-    if _cache_debug: print('SAVE CACHE', cache_file)
-    with open(cache_file, "a") as f:
-        f.write(json.dumps(dict(input=payload, output=data)) + '\n')
-    return data
-
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def _api3_safety(address: Dict) -> Dict:
+_cache_debug = False
+# config, response cache and worker pool are set up on first use, so that
+# importing this module (and starting the app) stays cheap
+_config = None
+_cache = None
+_executor = None
+_setup_lock = threading.RLock()
+
+
+def _get_config() -> Dict:
+    # HOMEAWARE_GATEWAY points the client at another gateway, e.g. a local
+    # python -m src.mock_gateway, which needs neither credentials nor connection.json
+    global _config
+    with _setup_lock:
+        if _config is None:
+            path = os.environ.get("HOMEAWARE_CONNECTION", "src/connection.json")
+            if os.path.exists(path) or "HOMEAWARE_GATEWAY" not in os.environ:
+                with open(path, "r") as fp:
+                    _config = json.loads(fp.read())
+            else:
+                _config = {}
+        return _config
+
+
+def _base() -> str:
+    return os.environ.get("HOMEAWARE_GATEWAY", _get_config().get("gateway", "https://gateway.oapi.bik.pl/"))
+
+
+def _get_cache() -> cache.Cache:
+    global _cache
+    with _setup_lock:
+        if _cache is None:
+            config = _get_config()
+            cache_dir = config.get("cache_dir", "src/.cache")
+            if not os.path.exists(cache_dir):
+                os.mkdir(cache_dir)
+            path = os.path.join(cache_dir, "responses.sqlite")
+            is_new = not os.path.exists(path)
+            _cache = cache.Cache(
+                path,
+                l1_size=config.get("cache_l1_size", 4096),
+                max_bytes=config.get("cache_max_mb", 512) * 2**20
+            )
+            if is_new:
+                # carry over responses stored in the old one-file-per-hash layout
+                cache.import_legacy(_cache, cache_dir)
+        return _cache
+
+
+metrics.describe("homeaware_gateway_request_seconds", "Gateway round-trip time per endpoint.")
+metrics.describe("homeaware_gateway_requests_total", "Gateway responses per endpoint and status.")
+metrics.describe("homeaware_gateway_retries_total", "Gateway requests retried per endpoint and status.")
+metrics.describe("homeaware_gateway_rejected_total", "Gateway requests not sent because the circuit was open.")
+metrics.describe("homeaware_cache_lookups_total", "Response cache lookups by tier and result.")
+metrics.describe("homeaware_cache_refreshes_total", "Background refreshes of expired responses by result.")
+metrics.describe("homeaware_criterion_seconds", "Time until every call of a criterion resolved.")
+metrics.describe("homeaware_criterions_seconds", "Time to compute all criteria of an uncached address.")
+
+
+@metrics.collector
+def _cache_metrics():
+    if _cache is None:
+        return
+    for name, value in _cache.counters.items():
+        yield "homeaware_cache_lookups_total", dict(result=name), value
+
+
+# at most this many requests in flight per endpoint family (e.g. "bik-api-4"),
+# connection.json "endpoint_limits" overrides these
+_endpoint_limits = {
+    "bik-api-3": 2,
+    "bik-api-4": 8,
+    "bik-api-5": 2,
+    "bik-api-6": 2,
+    "bik-api-10": 4,
+    "bik-api-11": 2,
+}
+_default_endpoint_limit = 4
+# called with the endpoint before every gateway request; src.crawl sets it to
+# share one request rate between processes
+throttle: Optional[Callable[[str], None]] = None
+_endpoint_semaphores = {}
+_endpoint_semaphores_lock = threading.Lock()
+# requests per second of the endpoint families in connection.json
+# "rate_limits", lowered while the gateway answers 429. Other families are
+# not limited until their first 429, then start from this rate (halved)
+_default_rate_limit = 20.0
+_rate_limiters = {}
+_breakers = {}
+
+
+def _max_workers() -> int:
+    # at most this many gateway calls are made at once
+    return _get_config().get("max_workers", 16)
+
+
+def _pool_size() -> int:
+    # one keep-alive connection per worker is enough to never wait on the pool
+    return _get_config().get("pool_size", _max_workers())
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _setup_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_max_workers(), thread_name_prefix="criterions")
+        return _executor
+
+
+# cache key -> future of the fetch currently running for it in this process
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# seconds a cached response is fresh, by endpoint prefix (the longest matching
+# one wins); connection.json "ttl" overrides these, null never expires. Expired
+# responses are still served while a background refresh replaces them
+_ttl = {
+    "bik-api-3": 7 * 24 * 3600,  # prices, crimes, collisions
+    "bik-api-4": 90 * 24 * 3600,
+    "bik-api-4/punkty-zainteresowania-adres": 180 * 24 * 3600,  # nearest POI distances
+    "bik-api-5": 30 * 24 * 3600,
+    "bik-api-6": 30 * 24 * 3600,
+    "bik-api-10": 90 * 24 * 3600,
+    "bik-api-11": 30 * 24 * 3600,
+    "coordinates": None,
+}
+_refresher = None
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+
+def _ttl_of(endpoint: str) -> Optional[float]:
+    ttl = {**_ttl, **_get_config().get("ttl", {})}
+    endpoint = endpoint.split("@")[0]
+    if endpoint == "criterions":
+        # whole results must not outlive the calls they were computed from
+        return min((t for t in ttl.values() if t is not None), default=None)
+    matches = [prefix for prefix in ttl if endpoint.startswith(prefix)]
+    return ttl[max(matches, key=len)] if matches else None
+
+
+def _expired(endpoint: str, created: float) -> bool:
+    ttl = _ttl_of(endpoint)
+    return ttl is not None and time.time() - created > ttl
+
+
+def _get_refresher() -> ThreadPoolExecutor:
+    global _refresher
+    with _setup_lock:
+        if _refresher is None:
+            _refresher = ThreadPoolExecutor(max_workers=_get_config().get("refresh_workers", 2), thread_name_prefix="refresh")
+        return _refresher
+
+
+def _revalidate(endpoint: str, payload: Any, refresh: Callable[[], Any]):
+    # runs refresh() in the background, once per key at a time
+    key = cache.key(endpoint, payload)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            refresh()
+            metrics.inc("homeaware_cache_refreshes_total", endpoint=endpoint, result="ok")
+        except Exception:
+            # keep serving the expired value, the next lookup tries again
+            metrics.inc("homeaware_cache_refreshes_total", endpoint=endpoint, result="error")
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+    _get_refresher().submit(run)
+
+
+def _cached(endpoint: str, payload: Any, fresh: bool, refresh: Callable[[], Any]) -> Optional[Any]:
+    # the cached value, also when it expired (and then refresh() is started),
+    # unless fresh is set: then only an unexpired value counts
+    entry = _get_cache().entry(endpoint, payload)
+    if entry is None:
+        return None
+    value, created = entry
+    if _expired(endpoint, created):
+        if fresh:
+            return None
+        _revalidate(endpoint, payload, refresh)
+    return value
+
+
+def _endpoint_semaphore(endpoint: str) -> threading.BoundedSemaphore:
+    family = endpoint.split("/")[0]
+    with _endpoint_semaphores_lock:
+        if family not in _endpoint_semaphores:
+            limits = {**_endpoint_limits, **_get_config().get("endpoint_limits", {})}
+            limit = limits.get(family, _default_endpoint_limit)
+            _endpoint_semaphores[family] = threading.BoundedSemaphore(limit)
+        return _endpoint_semaphores[family]
+
+
+def _rate_limiter(endpoint: str, throttled: bool = False) -> Optional[TokenBucket]:
+    family = endpoint.split("/")[0]
+    with _endpoint_semaphores_lock:
+        if family not in _rate_limiters:
+            rate = _get_config().get("rate_limits", {}).get(family)
+            if rate is None:
+                if not throttled:
+                    return None
+                rate = _default_rate_limit
+            _rate_limiters[family] = TokenBucket(rate, burst=max(1, int(rate)))
+        return _rate_limiters[family]
+
+
+def _breaker(endpoint: str) -> CircuitBreaker:
+    family = endpoint.split("/")[0]
+    with _endpoint_semaphores_lock:
+        if family not in _breakers:
+            config = _get_config()
+            _breakers[family] = CircuitBreaker(config.get("breaker_failures", 5), config.get("breaker_reset", 30.0))
+        return _breakers[family]
+
+
+def _coalesce(key: str, fun: Callable[[], Any]) -> Any:
+    # concurrent callers asking for the same key wait for a single call of fun
+    with _inflight_lock:
+        future = _inflight.get(key)
+        leader = future is None
+        if leader:
+            future = _inflight[key] = Future()
+    if not leader:
+        if _cache_debug: print('WAIT', key)
+        return future.result()
+    try:
+        future.set_result(fun())
+    except BaseException as e:
+        future.set_exception(e)
+    finally:
+        with _inflight_lock:
+            del _inflight[key]
+    return future.result()
+
+
+def _api(endpoint: str, payload: dict, base: str = None, fresh: bool = False) -> str:
+    base = base or _base()
+    # if endpoint + payload is cached in memory or on disk, return it
+    cached = _cached(endpoint, payload, fresh, lambda: _fetch(endpoint, payload, base, fresh=True))
+    if cached is not None:
+        if _cache_debug: print('CACHE', endpoint)
+        return cached
+    return _coalesce(cache.key(endpoint, payload) + ("!fresh" if fresh else ""), lambda: _fetch(endpoint, payload, base, fresh))
+
+
+def _fetch(endpoint: str, payload: dict, base: str, fresh: bool = False) -> str:
+    # retries timeouts, 429 and 5xx with backoff; raises GatewayError once
+    # retries run out, the circuit of the endpoint family is open or the
+    # gateway rejects the request
+    retries = _get_config().get("retries", 4)
+    for attempt in range(retries + 1):
+        with _get_cache().single_flight(endpoint, payload):
+            # another process (or thread) may have fetched it while we waited
+            entry = _get_cache().shared_entry(endpoint, payload)
+            if entry is not None and not (fresh and _expired(endpoint, entry[1])):
+                if _cache_debug: print('CACHE', endpoint)
+                return entry[0]
+
+            # payloads the gateway rejected are not asked for again until negative_ttl passes
+            failed = _get_cache().get(endpoint + "!failed", payload, count=False)
+            if failed is not None and failed["until"] > time.time():
+                raise GatewayError(endpoint, failed["status"], "(known bad payload)")
+
+            if _cache_debug: print('FETCH', endpoint)
+            try:
+                data = _post(endpoint, json.dumps(payload), base)
+            except GatewayError as e:
+                if not e.retryable and e.status not in (401, 403):
+                    until = time.time() + _get_config().get("negative_ttl", 24 * 3600)
+                    _get_cache().put(endpoint + "!failed", payload, dict(status=e.status, until=until))
+                if not e.retryable or attempt == retries or _breaker(endpoint).open:
+                    raise
+                error = e
+            else:
+                if _cache_debug: print('SAVE CACHE', endpoint)
+                _get_cache().put(endpoint, payload, data)
+                return data
+        # outside the lock: other payloads sharing its stripe need not wait
+        metrics.inc("homeaware_gateway_retries_total", endpoint=endpoint, status=error.status or "error")
+        time.sleep(backoff(attempt, retry_after=error.retry_after))
+
+
+def _post(endpoint: str, payload_str: str, base: str) -> Any:
+    # a single attempt; the circuit breaker and rate limit of the endpoint
+    # family learn from its outcome
+    config = _get_config()
+    limiter, breaker = _rate_limiter(endpoint), _breaker(endpoint)
+    if not breaker.allow():
+        metrics.inc("homeaware_gateway_rejected_total", endpoint=endpoint)
+        raise GatewayError(endpoint, None, "(circuit open)")
+    response, status = None, None
+    try:
+        if limiter is not None:
+            limiter.acquire()
+        with _endpoint_semaphore(endpoint):
+            if throttle is not None:
+                throttle(endpoint)
+            start = time.perf_counter()
+            try:
+                response = transport.session(config, _pool_size()).post(
+                    urljoin(base, endpoint),
+                    data=payload_str,
+                    timeout=transport.timeout(config)
+                )
+                status = response.status_code
+            except RequestException:
+                pass
+            metrics.observe("homeaware_gateway_request_seconds", time.perf_counter() - start, endpoint=endpoint)
+    except BaseException:
+        # e.g. a bad client certificate or a throttle hook raising; without
+        # a record() a half-open trial would keep the circuit open for good
+        breaker.record(False)
+        raise
+    metrics.inc("homeaware_gateway_requests_total", endpoint=endpoint, status=status or "error")
+    if status == 200:
+        breaker.record(True)
+        if limiter is not None:
+            limiter.succeeded()
+        return response.json()
+
+    error = GatewayError(endpoint, status, retry_after=response.headers.get("Retry-After") if response is not None else None)
+    if status == 429:
+        _rate_limiter(endpoint, throttled=True).throttled()
+    # a rejected request is wrong itself, the gateway is fine
+    breaker.record(not error.retryable)
+    raise error
+
+
+def _api3_safety(address: Dict) -> Call:
     payload = {
             "address": {
                 "code": str(address["code"]),
@@ -84,47 +364,47 @@ def _api3_safety(address: Dict) -> Dict:
             "grid_list": [500],
             "category_list": ["price", "crime", "road_accident"],
     }
-    
-    return _api("bik-api-3/bezpieczenstwo-adres", payload)[0]["details"]
+    return Call("bik-api-3/bezpieczenstwo-adres", payload, lambda r: r[0]["details"], grid=500, address=address)
+
 
-def _api4_nearest_poi(address: Dict, poi_type: str) -> float:
+def _api4_nearest_poi(address: Dict, poi_type: str) -> Call:
     payload = {
         "size": "100",
         "address": address,
         "nearestPOI": poi_type
     }
-    return _api("bik-api-4/punkty-zainteresowania-adres", payload)["nearestPOI"]
+    return Call("bik-api-4/punkty-zainteresowania-adres", payload, lambda r: r["nearestPOI"][poi_type])
 
 
-def _api4_number_poi(address: Dict, poi_type: str) -> float:
+def _api4_number_poi(address: Dict, poi_type: str) -> Call:
     payload = {
         "size": "500",
         "address": address,
         "poinumber": poi_type
     }
-    return _api("bik-api-4/liczba-poi-adres", payload)["poinumber"]
+    return Call("bik-api-4/liczba-poi-adres", payload, lambda r: r["poinumber"][poi_type], grid=500, address=address)
     
     
-def _api4_demographic(address: Dict, demographicData: str) -> float:
+def _api4_demographic(address: Dict, demographicData: str) -> Call:
     payload = {
         "size": "100",
         "address": address,
         "demographicData": demographicData
     }
-    return _api("bik-api-4/dane-demograficzne-adres", payload)["demographicData"]
+    return Call("bik-api-4/dane-demograficzne-adres", payload, lambda r: r["demographicData"][demographicData])
     
     
-def _api6(address: Dict, section: str) -> float:
+def _api6(address: Dict, section: str) -> Call:
     payload = {
         "size": "STAT_250M",
         "productCode": "ALL",
         "address": address,
         "section": section
     }
-    return _api("bik-api-6/address", payload)["geostats"]    
+    return Call("bik-api-6/address", payload, lambda r: r["geostats"][0])
 
 
-def _api10_address_point(address: Dict, address_point: str) -> float:
+def _api10_address_point(address: Dict, address_point: str) -> Call:
     payload = {
         "size": "100",
         "address": {
@@ -135,10 +415,10 @@ def _api10_address_point(address: Dict, address_point: str) -> float:
         },
         "addressPoint": address_point
     }
-    return _api("bik-api-10/odleglosc-punkt-adres", payload)["addressPoint"]
+    return Call("bik-api-10/odleglosc-punkt-adres", payload, lambda r: float(r["addressPoint"][address_point]))
 
 
-def _api10_area_statistic(address: Dict, area_statistic: str) -> float:
+def _api10_area_statistic(address: Dict, area_statistic: str) -> Call:
     payload = {
         "size": "500",
         "address": {
@@ -149,10 +429,11 @@ def _api10_area_statistic(address: Dict, area_statistic: str) -> float:
         },
         "areaStatistic": area_statistic
     }
-    return _api("bik-api-10/charakterystyka-obszaru-adres", payload)["areaStatistic"]
+    extract = lambda r: r["areaStatistic"][area_statistic]
+    return Call("bik-api-10/charakterystyka-obszaru-adres", payload, extract, grid=500, address=address)
 
-def _api11(address: Dict, activity: str) -> float:
-    address = {
+def _api11(address: Dict, activity: str) -> Call:
+    api_address = {
         "code": str(address)[:2] + "-" + str(address)[2:],
         "city": address["city"],
         "street": address["street"],
@@ -161,82 +442,108 @@ def _api11(address: Dict, activity: str) -> float:
     
     payload = {
         "size": "500M",
-        "address": address,
+        "address": api_address,
         "category": activity
     }
-    return float(_api("bik-api-11/zachowania-wg-adresu", payload)["value"][:-1])
+    extract = lambda r: float(r["value"][:-1])
+    return Call("bik-api-11/zachowania-wg-adresu", payload, extract, grid=500, address=address)
 
 
-def airports(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_TRANSPORT_LOTNISKO_MIEDZYNARODOWE")["D_TRANSPORT_LOTNISKO_MIEDZYNARODOWE"]
+# Every criterion declares the calls it needs for an address and how to reduce
+# their responses, see src.plan. Evaluate a single one with evaluate().
 
+def airports(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_TRANSPORT_LOTNISKO_MIEDZYNARODOWE")])
 
-def between_20_30(address: Dict) -> float:
+
+def between_20_30(address: Dict) -> Need:
     groups = [
         "POPT2024",
         "POPT2529"
     ]
-    return sum([_api4_demographic(address, group)[group] for group in groups])
+    return Need([_api4_demographic(address, group) for group in groups], lambda *counts: sum(counts))
 
 
-def bus_stop(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY")["D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY"]
+def bus_stop(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_TRANSPORT_PRZYSTANEK_AUTOBUSOWY")])
 
 
-def car_collisions(data: Dict) -> float:
-    return data["details"]["hitting_a_pedestrian"]
+def car_collisions(address: Dict) -> Need:
+    return Need([_api3_safety(address)], lambda data: data[2]["details"]["hitting_a_pedestrian"])
 
 
-def civil_services(address: Dict) -> float:
+def civil_services(address: Dict) -> Need:
     fire_stations = [
         "D_URZAD_I_SLUZBA_PUBLICZNA_SLUZBY_PUBLICZNE_OCHOTNICZA_STRAZ_POZARNA",
         "D_URZAD_I_SLUZBA_PUBLICZNA_SLUZBY_PUBLICZNE_STRAZ_POZARNA"
     ]
-    fire_stations = [_api4_nearest_poi(address, poi)[poi] for poi in fire_stations]
-    police = _api4_nearest_poi(address, "D_URZAD_I_SLUZBA_PUBLICZNA_SLUZBY_PUBLICZNE_KOMENDA_POLICJI")["D_URZAD_I_SLUZBA_PUBLICZNA_SLUZBY_PUBLICZNE_KOMENDA_POLICJI"]
-    return (min(fire_stations) + police) / 2
+    police = "D_URZAD_I_SLUZBA_PUBLICZNA_SLUZBY_PUBLICZNE_KOMENDA_POLICJI"
+    calls = [_api4_nearest_poi(address, poi) for poi in fire_stations + [police]]
+    return Need(calls, lambda volunteer, fire, police: (min(volunteer, fire) + police) / 2)
 
     
-def coordinates(address: Dict) -> tuple:
-    result = _api6(address, "SR_CR3_KREDYTOBIORCY")[0]["inputDataCoordinates"]
+def coordinates(address: Dict) -> Need:
+    return Need([_api6(address, "SR_CR3_KREDYTOBIORCY")], _utm)
+
+
+def _utm(stats: Dict) -> tuple:
+    result = stats["inputDataCoordinates"]
     return result["utm_x"], result["utm_y"]
 
 
-def cr3(address: Dict) -> tuple:
-    res = _api6(address, "SR_CR3_KREDYTOBIORCY")[0]["result"]
+def zone(city: Optional[str] = None) -> Tuple[int, bool]:
+    # UTM zone the gateway uses for addresses of a city: connection.json
+    # "utm_zones" ({"Wrocław": "33U"}, or the [lat, lon] of the city to infer
+    # it from), then the zone of a known city centre, then "utm_zone" (34U)
+    config = _get_config()
+    zones = {name.casefold(): z for name, z in {**geo.cities, **config.get("utm_zones", {})}.items()}
+    z = zones.get(str(city or "").strip().casefold(), config.get("utm_zone", "34U"))
+    return geo.parse_zone(z if isinstance(z, str) else geo.zone_of(*z))
+
+
+def to_latlon(x, y, city: str) -> Tuple[float, float]:
+    lat, lon = geo.to_latlon(x, y, *zone(city))
+    return float(lat), float(lon)
+
+
+def cr3(address: Dict) -> Need:
+    return Need([_api6(address, "SR_CR3_KREDYTOBIORCY")], _cr3)
+
+
+def _cr3(stats: Dict) -> float:
+    res = stats["result"]
     if res == "null": return 0
     return float(res)
 
 
-def crimes(data: Dict) -> float:
-    return sum(data["details"].values())
+def crimes(address: Dict) -> Need:
+    return Need([_api3_safety(address)], lambda data: sum(data[1]["details"].values()))
 
 
-def consumer_expenses(address: Dict) -> float:
+def consumer_expenses(address: Dict) -> Need:
     payload = {
         "size": 100,
         "address": address,
         "wealth": "WK_RAZEM"
     }
-    return _api("bik-api-4/zamoznosc-adres", payload)["wealth"]["WK_RAZEM"]
+    return Need([Call("bik-api-4/zamoznosc-adres", payload, lambda r: r["wealth"]["WK_RAZEM"])])
 
 
-def culture_entertainment(address: Dict) -> float:
+def culture_entertainment(address: Dict) -> Need:
     pois = [
         "D_ROZRYWKA_I_KULTURA_KINO",
         "D_ROZRYWKA_I_KULTURA_KREGIELNIE",
         "D_ROZRYWKA_I_KULTURA_MUZEUM",
         "D_ROZRYWKA_I_KULTURA_TEATR"
     ]
-    distances = [_api4_nearest_poi(address, poi)[poi] for poi in pois]
-    return sum(distances) / len(distances)
+    return Need([_api4_nearest_poi(address, poi) for poi in pois], lambda *distances: sum(distances) / len(distances))
 
 
-def dating_apps(address: Dict) -> float:
-    return _api11(address, "PROFILE_DATING")
+def dating_apps(address: Dict) -> Need:
+    return Need([_api11(address, "PROFILE_DATING")])
 
 
-def education(address: Dict) -> float:
+def education(address: Dict) -> Need:
     pois = [
         "EDUKACJA_PRZEDSZKOLA_I_PUNKTY_PRZEDSZKOLNE",
         "EDUKACJA_SZKOLY_PODSTAWOWE",
@@ -245,108 +552,258 @@ def education(address: Dict) -> float:
         "EDUKACJA_TECHNIKA",
         "EDUKACJA_SZKOLY_BRANZOWE",
     ]
-    return sum([_api4_number_poi(address, poi)[poi] for poi in pois])
+    return Need([_api4_number_poi(address, poi) for poi in pois], lambda *counts: sum(counts))
 
 
-def freeways(address: Dict) -> float:
-    autostr = float(_api10_address_point(address, "odl_autost")["odl_autost"])
-    ekspres = float(_api10_address_point(address, "odl_drEksp")["odl_drEksp"])
-    return min(autostr, ekspres)
+def freeways(address: Dict) -> Need:
+    return Need([_api10_address_point(address, "odl_autost"), _api10_address_point(address, "odl_drEksp")], min)
     
 
-def garages(address: Dict) -> float:
-    return int(_api10_area_statistic(address, "garaze")["garaze"])
+def garages(address: Dict) -> Need:
+    return Need([_api10_area_statistic(address, "garaze")], int)
+
+
+def geoscore(address: Dict) -> Need:
+    return Need([Call("bik-api-5/geoscore-adres", address, lambda r: float(r["score"]))])
 
 
-def geoscore(address: Dict) -> float:
-    return float(_api("bik-api-5/geoscore-adres", address)["score"])
+def health(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_ZDROWIE")])
 
 
-def health(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_ZDROWIE")["D_ZDROWIE"]
+def latlon(address: Dict) -> Need:
+    return Need([_api6(address, "SR_CR3_KREDYTOBIORCY")], lambda stats: to_latlon(*_utm(stats), address["city"]))
 
 
-def mall(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_CENTRUM_HANDLOWE")["D_CENTRUM_HANDLOWE"]
+def mall(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_CENTRUM_HANDLOWE")])
 
 
-def nature(address: Dict) -> float:
-    lasy = float(_api10_area_statistic(address, "lasy")["lasy"])
-    zielen = float(_api10_area_statistic(address, "zielen_mi")["zielen_mi"])
-    return lasy + zielen
+def nature(address: Dict) -> Need:
+    calls = [_api10_area_statistic(address, "lasy"), _api10_area_statistic(address, "zielen_mi")]
+    return Need(calls, lambda lasy, zielen: float(lasy) + float(zielen))
 
 
-def over_60(address: Dict) -> float:
+def over_60(address: Dict) -> Need:
     groups = [
         "POPT6064",
         "POPT6569",
         "POPT7074",
         "POPT7599"
     ]
-    return sum([_api4_demographic(address, group)[group] for group in groups])
+    return Need([_api4_demographic(address, group) for group in groups], lambda *counts: sum(counts))
 
 
-def parcel_lockers(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_PRZESYLKI_PACZKOMAT")["D_PRZESYLKI_PACZKOMAT"]
+def parcel_lockers(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_PRZESYLKI_PACZKOMAT")])
 
 
-def post_office(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_POCZTA")["D_POCZTA"]
+def post_office(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_POCZTA")])
 
 
-def price(data: Dict) -> float:
-    return data["details"]["offer_price"]
+def price(address: Dict) -> Need:
+    return Need([_api3_safety(address)], lambda data: data[0]["details"]["offer_price"])
 
 
-def price_and_safety(address: Dict) -> Tuple[float, float, float]:
-    data = _api3_safety(address)
-    return price(data[0]), crimes(data[1]), car_collisions(data[2])
+def railway_station(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_TRANSPORT_PKP_PRZYSTANEK_LUB_STACJA_DWORZEC")])
 
 
-def railway_station(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_TRANSPORT_PKP_PRZYSTANEK_LUB_STACJA_DWORZEC")["D_TRANSPORT_PKP_PRZYSTANEK_LUB_STACJA_DWORZEC"]
+def railway_tracks(address: Dict) -> Need:
+    return Need([_api10_address_point(address, "odl_tory")])
 
 
-def railway_tracks(address: Dict) -> float:
-    return float(_api10_address_point(address, "odl_tory")["odl_tory"])
+def sport(address: Dict) -> Need:
+    return Need([_api11(address, "PROFILE_SPORT_ACTIVE")])
 
 
-def sport(address: Dict) -> float:
-    return _api11(address, "PROFILE_SPORT_ACTIVE")
+def tram_stop(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_TRANSPORT_PRZYSTANEK_TRAMWAJOWY")])
 
 
-def tram_stop(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_TRANSPORT_PRZYSTANEK_TRAMWAJOWY")["D_TRANSPORT_PRZYSTANEK_TRAMWAJOWY"]
+def university(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_EDUKACJA_WYZSZE_SZKOLY_PUBLICZNE")])
 
 
-def university(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_EDUKACJA_WYZSZE_SZKOLY_PUBLICZNE")["D_EDUKACJA_WYZSZE_SZKOLY_PUBLICZNE"]
+def worship(address: Dict) -> Need:
+    return Need([_api4_nearest_poi(address, "D_MIEJSCE_KULTU_KOSCIOL")])
 
 
-def worship(address: Dict) -> float:
-    return _api4_nearest_poi(address, "D_MIEJSCE_KULTU_KOSCIOL")["D_MIEJSCE_KULTU_KOSCIOL"]
+CRITERIA = [
+    consumer_expenses, university, education, dating_apps, between_20_30, 
+    parcel_lockers, civil_services, railway_tracks, freeways, airports, 
+    nature, garages, bus_stop, tram_stop, railway_station, post_office, 
+    mall, culture_entertainment, health, geoscore, cr3, over_60, worship, 
+    sport, coordinates, price, crimes, car_collisions, latlon
+]
 
 
-@lru_cache(maxsize=256)
-def criterions(code: int, city: str, street: str, buildingNumber: int) -> Dict:
-    functions = [
-        consumer_expenses, university, education, dating_apps, between_20_30, 
-        parcel_lockers, civil_services, railway_tracks, freeways, airports, 
-        nature, garages, bus_stop, tram_stop, railway_station, post_office, 
-        mall, culture_entertainment, health, geoscore, cr3, over_60, worship, 
-        sport, coordinates
-    ]
-    address = { "code": code, "city": city, "street": street, "buildingNumber": buildingNumber }
-    results = {fun.__name__: fun(address) for fun in functions}
-    price, crimes, car_collisions = price_and_safety(address)
-    results["price"] = price
-    results["crimes"] = crimes
-    results["car_collisions"] = car_collisions
-    a, b = results["coordinates"]
-    results["latlon"] = utm.to_latlon(a, b, 34, 'U') # Hardcode Łódź
+def _grid_cache() -> bool:
+    # off unless connection.json sets "grid_cache": cells are guessed as
+    # multiples of the grid size from the UTM origin; if the gateway's own
+    # grid is offset (or liczba-poi-adres counts around the point rather than
+    # per cell) an address would get a neighbour's values
+    return _get_config().get("grid_cache", False)
+
+
+def _call(call: Call, fresh: bool = False) -> Any:
+    # serve area-level statistics from a cache shared by every address in a cell
+    if call.grid and _grid_cache():
+        return _cell_api(call, fresh)
+    return _api(call.endpoint, call.payload, fresh=fresh)
+
+
+def locate(address: Dict) -> Tuple[float, float]:
+    # UTM coordinates of an address, kept on their own so that grid lookups
+    # don't need the whole bik-api-6 response
+    cached = _get_cache().get("coordinates", address)
+    if cached is not None:
+        return tuple(cached)
+    call = coordinates(address).calls[0]
+    xy = _utm(call.extract(_api(call.endpoint, call.payload)))
+    _get_cache().put("coordinates", address, xy)
+    return xy
+
+
+def cell(address: Dict, size: int) -> Tuple[int, int]:
+    x, y = locate(address)
+    return int(x // size), int(y // size)
+
+
+def _cell_call(call: Call, xy: Tuple[float, float]) -> Tuple[str, Dict]:
+    # the statistic is the same for every address in the cell, so it is cached
+    # under the cell instead of the address
+    payload = {k: v for k, v in call.payload.items() if k != "address"}
+    payload["cell"] = [call.grid, int(xy[0] // call.grid), int(xy[1] // call.grid)]
+    return call.endpoint + "@cell", payload
+
+
+def _cell_api(call: Call, fresh: bool = False) -> Any:
+    endpoint, payload = _cell_call(call, locate(call.address))
+
+    def fetch():
+        # never from an expired response, the cell entry gets a new timestamp
+        data = _api(call.endpoint, call.payload, fresh=True)
+        _get_cache().put(endpoint, payload, data)
+        return data
+    cached = _cached(endpoint, payload, fresh, fetch)
+    if cached is not None:
+        return cached
+    return _coalesce(cache.key(endpoint, payload), fetch)
+
+
+def is_cached(call: Call) -> bool:
+    # whether _call would answer without a gateway request
+    store = _get_cache()
+    if store.get(call.endpoint, call.payload, count=False) is not None:
+        return True
+    if call.grid and _grid_cache():
+        xy = store.get("coordinates", call.address, count=False)
+        return xy is not None and store.get(*_cell_call(call, xy), count=False) is not None
+    return False
+
+
+def cost(calls: Iterable[Call]) -> int:
+    # gateway requests needed for these calls right now
+    return len({call.key for call in calls if not is_cached(call)})
+
+
+def plan(*addresses: Dict) -> Plan:
+    return Plan(addresses, CRITERIA)
+
+
+def _run(p: Plan, fresh: bool = False) -> List[Dict]:
+    results = p.run(lambda call: _call(call, fresh), _get_executor())
+    for seconds in p.criterion_seconds():
+        for name, s in seconds.items():
+            metrics.observe("homeaware_criterion_seconds", s, criterion=name)
     return results
+
+
+def evaluate(criterion: Callable[[Dict], Need], address: Dict) -> Any:
+    return _run(Plan([address], [criterion]))[0][criterion.__name__]
+
+
+def criterions_batch(addresses: List[Dict]) -> List[Dict]:
+    # one plan for the whole batch so shared calls are fetched once
+    return _run(plan(*addresses))
+
+
+def address_of(variant: Dict) -> Dict:
+    # criterions() arguments for a location as entered in the app or a CSV
+    return dict(
+        code=int(re.sub("[^0-9]", "", str(variant['Postal Code']))),
+        city=variant['City'],
+        street=variant['Street'],
+        buildingNumber=int(variant['Building No.'])
+    )
+
+
+def criterions(code: int, city: str, street: str, buildingNumber: int, only: Optional[Tuple[str, ...]] = None) -> Dict:
+    # only=(names, ...) evaluates just those criteria, e.g. the ones that can
+    # change the score (model.required_criteria), and skips the other calls
+    address = { "code": code, "city": city, "street": street, "buildingNumber": buildingNumber }
+    # whole results are shared with other replicas through the response cache
+    cached = _cached("criterions", address, False, lambda: _fetch_criterions(address))
+    if cached is not None:
+        results = _from_cache(cached)
+        return results if only is None else {name: results[name] for name in only}
+    if only is not None:
+        return _run(Plan([address], [criterion for criterion in CRITERIA if criterion.__name__ in only]))[0]
+    return _coalesce(cache.key("criterions", address), lambda: _fetch_criterions(address))
+
+
+def stream_criterions(addresses: List[Dict], only: Optional[Tuple[str, ...]] = None,
+                      first: Tuple[str, ...] = ("coordinates", "latlon")) -> Iterator[Tuple[int, str, Any]]:
+    # yields (address index, criterion, value) as each value becomes
+    # available, the criteria in `first` are requested before the others
+    criteria = [criterion for criterion in CRITERIA if only is None or criterion.__name__ in only]
+    pending = []
+    for i, address in enumerate(addresses):
+        cached = _cached("criterions", address, False, lambda address=address: _fetch_criterions(address))
+        if cached is None:
+            pending.append(i)
+            continue
+        results = _from_cache(cached)
+        for criterion in criteria:
+            yield i, criterion.__name__, results[criterion.__name__]
+
+    p = Plan([addresses[i] for i in pending], criteria)
+    results = defaultdict(dict)
+    for j, name, value in p.stream(_call, _get_executor(), first):
+        yield pending[j], name, value
+        results[j][name] = value
+        if only is None and len(results[j]) == len(criteria):
+            # complete, but possibly from expired responses: criterions()
+            # gets its entry from a fresh run in the background
+            del results[j]
+            address = p.addresses[j]
+            _revalidate("criterions", address, lambda address=address: _fetch_criterions(address))
+
+
+def _fetch_criterions(address: Dict) -> Dict:
+    with _get_cache().single_flight("criterions", address):
+        entry = _get_cache().shared_entry("criterions", address)
+        if entry is not None and not _expired("criterions", entry[1]):
+            return _from_cache(entry[0])
+        # every unique call of every criterion is fetched at once; per-endpoint
+        # limits in _api keep us within what the gateway tolerates. Only
+        # unexpired responses go into an entry stamped now
+        with metrics.timer("homeaware_criterions_seconds"):
+            results = _run(plan(address), fresh=True)[0]
+        _get_cache().put("criterions", address, results)
+        return results
+
+
+def _from_cache(results: Dict) -> Dict:
+    # JSON has no tuples
+    return {**results, "coordinates": tuple(results["coordinates"]), "latlon": tuple(results["latlon"])}
     
 
 if __name__ == '__main__':
-    #print(university(dict(code=91224, city="Łódź", street="ALEKSANDROWSKA", buildingNumber=104)))
-    print(criterions(code=91224, city="Łódź", street="ALEKSANDROWSKA", buildingNumber=104))
+    address = dict(code=91224, city="Łódź", street="ALEKSANDROWSKA", buildingNumber=104)
+    p = plan(address)
+    print(f'{len(p)} unique calls ({p.requested()} requested):', dict(p.endpoints()))
+    #print(evaluate(university, address))
+    print(criterions(**address))
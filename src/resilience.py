@@ -0,0 +1,104 @@
+import random
+import threading
+import time
+
+from typing import Optional
+
+
+# Building blocks of the gateway client in src.req: a rate limiter that backs
+# off when the gateway throttles, a circuit breaker and retry delays.
+
+
+class GatewayError(Exception):
+    # status is None when no response came back (timeout, connection error,
+    # open circuit); retry_after is the Retry-After header, if any
+
+    def __init__(self, endpoint: str, status: Optional[int], message: str = "", retry_after: Optional[str] = None):
+        super().__init__(f"{endpoint}: {status or 'no response'} {message}".rstrip())
+        self.endpoint = endpoint
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class TokenBucket:
+    # `rate` requests per second on average, bursts of up to `burst`. The rate
+    # is halved whenever the gateway answers 429 and grows back by a twentieth
+    # of max_rate with every success (AIMD), so we settle just below the quota
+
+    def __init__(self, rate: float, burst: int, min_rate: float = 0.5):
+        self.max_rate = self.rate = rate
+        self.burst = burst
+        self.min_rate = min(min_rate, rate)
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # take the token now, possibly going into debt, and wait it off
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitBreaker:
+    # after `failures` retryable failures in a row calls fail fast for `reset`
+    # seconds, then a single trial call decides whether to close again
+
+    def __init__(self, failures: int = 5, reset: float = 30.0):
+        self.failures = failures
+        self.reset = reset
+        self._count = 0
+        self._opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def open(self) -> bool:
+        return self._opened is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.monotonic() - self._opened < self.reset:
+                return False
+            self._trial = True
+            return True
+
+    def record(self, success: bool):
+        with self._lock:
+            self._trial = False
+            if success:
+                self._count, self._opened = 0, None
+                return
+            self._count += 1
+            if self._count >= self.failures or self._opened is not None:
+                self._opened = time.monotonic()
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 30.0, retry_after: Optional[str] = None) -> float:
+    # seconds before retry number attempt + 1: what Retry-After asks for if it
+    # is given in seconds, exponential with full jitter otherwise
+    if retry_after is not None:
+        try:
+            return min(cap, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,163 @@
+import argparse
+import csv
+import sys
+import time
+
+import numpy as np
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from src import columnar, metrics
+from src.model import (
+    batch_partial_utilities, coarse_criteria, coarse_profiles, default_thresholds, fine_criteria, fine_sources,
+    required_criteria, score_bounds, threshold_vector, utility_bounds, widen_bounds
+)
+from src.prefetch import read_addresses
+from src.req import CRITERIA, cost, evaluate
+
+
+# Best k of many addresses without fetching every criterion of every address.
+# Criteria that are free (cached, or in a precomputed dataset) are read first.
+# Then, best candidates first, each candidate gets its cheapest missing
+# criterion at a time. A candidate whose best possible score (model.score_bounds)
+# is below the k-th best guaranteed score is dropped, and none of its other
+# criteria are fetched.
+
+
+def _gateway_requests() -> float:
+    return sum(row["value"] for row in metrics.snapshot()["counters"].get("homeaware_gateway_requests_total", []))
+
+
+class Search:
+    def __init__(self, addresses: List[Dict], weights: Dict, thresh: Dict, k: int = 10):
+        self.addresses = addresses
+        self.weights = weights
+        self.thresh = thresh
+        self.k = k
+        self.bounds = utility_bounds(thresh)
+        names = required_criteria(weights)
+        self.criteria = {criterion.__name__: criterion for criterion in CRITERIA if criterion.__name__ in names}
+        self.columns = {name: [c for c, source in enumerate(fine_sources) if source == name] for name in names}
+        # how much knowing a criterion can move a score, the tie breaker between equally cheap ones
+        total = sum(weights.values())
+        share = np.zeros(len(fine_criteria))
+        for group, members in coarse_criteria.items():
+            for fine in members:
+                share[fine_criteria.index(fine)] = weights[group] / total / len(members)
+        width = share * (self.bounds[1] - self.bounds[0])
+        self.impact = {name: width[columns].sum() for name, columns in self.columns.items()}
+        self.X = np.full((len(addresses), len(fine_criteria)), np.nan)
+        self.todo = [set(names) for _ in addresses]
+        self.details = [{} for _ in addresses]
+        self.failed = set()
+        self.evaluations = 0
+        # set once a fetched value lay outside the bounds pruning assumed
+        self.widened = False
+
+    def _known(self, i: int, name: str, value):
+        self.X[i, self.columns[name]] = value
+        self.details[i][name] = value
+        self.todo[i].discard(name)
+
+    def _cost(self, i: int, name: str) -> int:
+        return cost(self.criteria[name](self.addresses[i]).calls)
+
+    def score_bounds(self):
+        fine = batch_partial_utilities(self.X, threshold_vector(self.thresh))
+        lo, hi = self.bounds
+        if (fine < lo).any() or (fine > hi).any():
+            # a candidate dropped on the old bounds gets back in if it can now
+            # reach the top k; one with such a value among its unfetched
+            # criteria can't be told apart, so the result is no longer exact
+            self.bounds = widen_bounds(self.bounds, fine)
+            self.widened = True
+        return score_bounds(fine, self.bounds, self.weights)
+
+    def _evaluate(self, i: int, name: str):
+        try:
+            return evaluate(self.criteria[name], self.addresses[i])
+        except Exception as e:
+            print(f"{self.addresses[i]} failed: {e}", file=sys.stderr)
+            return None
+
+    def run(self, dataset: Optional[columnar.Table] = None, batch: int = 32, workers: int = 8) -> List[Dict]:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # free criteria: precomputed ones, then the ones with every call cached
+            if dataset is not None:
+                # the whole dataset tells how far sources go past their nominal range
+                self.bounds = widen_bounds(self.bounds, batch_partial_utilities(
+                    dataset.matrix(fine_sources), threshold_vector(self.thresh)))
+                for i, address in enumerate(self.addresses):
+                    known = dataset.get(address) or {}
+                    for name in self.todo[i] & known.keys():
+                        self._known(i, name, known[name])
+            free = [(i, name) for i in range(len(self.addresses)) for name in self.todo[i] if self._cost(i, name) == 0]
+            self._apply(free, executor.map(lambda job: self._evaluate(*job), free))
+
+            while True:
+                lower, upper = self.score_bounds()
+                lower[list(self.failed)] = upper[list(self.failed)] = -np.inf
+                kth = np.sort(lower)[-self.k] if len(lower) >= self.k else -np.inf
+                alive = [i for i in np.argsort(-upper) if self.todo[i] and upper[i] >= kth and i not in self.failed]
+                if not alive:
+                    break
+                # candidates that can still score best go first, they raise the
+                # k-th guaranteed score the fastest
+                jobs = [(i, min(self.todo[i], key=lambda name: (self._cost(i, name), -self.impact[name])))
+                        for i in alive[:batch]]
+                self._apply(jobs, executor.map(lambda job: self._evaluate(*job), jobs))
+
+        lower, _ = self.score_bounds()
+        complete = [i for i in range(len(self.addresses)) if not self.todo[i] and i not in self.failed]
+        best = sorted(complete, key=lambda i: -lower[i])[:self.k]
+        return [dict(index=i, address=self.addresses[i], score=float(lower[i]), details=self.details[i]) for i in best]
+
+    def _apply(self, jobs, values):
+        for (i, name), value in zip(jobs, values):
+            self.evaluations += 1
+            if value is None:
+                self.failed.add(i)
+            else:
+                self._known(i, name, value)
+
+    def pruned(self) -> int:
+        return sum(1 for i, todo in enumerate(self.todo) if todo and i not in self.failed)
+
+
+def search(addresses: List[Dict], weights: Dict, thresh: Dict = default_thresholds, k: int = 10,
+           dataset: Optional[columnar.Table] = None, batch: int = 32, workers: int = 8) -> List[Dict]:
+    return Search(addresses, weights, thresh, k).run(dataset, batch, workers)
+
+
+def main():
+    profiles = coarse_profiles()
+    parser = argparse.ArgumentParser(description="Best k addresses of a CSV (City, Street, Building No., Postal Code) for a profile, fetching as few criteria as possible.")
+    parser.add_argument("addresses", help="input CSV")
+    parser.add_argument("--profile", default="Student", choices=list(profiles))
+    parser.add_argument("-k", "--top", type=int, default=10)
+    parser.add_argument("--dataset", default=None, help="precomputed criteria (src.columnar) to read first")
+    parser.add_argument("--batch", type=int, default=32, help="candidates advanced per round")
+    parser.add_argument("--workers", type=int, default=8, help="criteria fetched at once")
+    args = parser.parse_args()
+
+    addresses = list(read_addresses(args.addresses))
+    dataset = columnar.Table.load(args.dataset) if args.dataset else None
+    s = Search(addresses, profiles[args.profile], default_thresholds, args.top)
+    requests, start = _gateway_requests(), time.time()
+    best = s.run(dataset, args.batch, args.workers)
+    print(f"{len(addresses)} addresses in {time.time() - start:.1f}s: {s.evaluations} criteria evaluated, "
+          f"{_gateway_requests() - requests:.0f} gateway requests, {s.pruned()} addresses pruned, "
+          f"{len(s.failed)} failed", file=sys.stderr)
+    if s.widened:
+        print("some criteria were outside their usual range, pruned addresses may have been in the top k", file=sys.stderr)
+
+    writer = csv.writer(sys.stdout)
+    writer.writerow(["Rank", "MatchScore", "Postal Code", "City", "Street", "Building No."])
+    for rank, result in enumerate(best, start=1):
+        a = result["address"]
+        writer.writerow([rank, result["score"], a["code"], a["city"], a["street"], a["buildingNumber"]])
+
+
+if __name__ == '__main__':
+    main()
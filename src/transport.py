@@ -0,0 +1,72 @@
+import ssl
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.ssl_ import create_urllib3_context
+from typing import Dict, Optional, Tuple
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+class _MutualTLSAdapter(HTTPAdapter):
+    # the client certificate is loaded into a single SSL context up front,
+    # every pooled connection reuses it instead of reading the key again
+
+    def __init__(self, ssl_context: Optional[ssl.SSLContext], **kwargs):
+        self._ssl_context = ssl_context
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        if self._ssl_context is not None:
+            kwargs["ssl_context"] = self._ssl_context
+        return super().init_poolmanager(*args, **kwargs)
+
+    def proxy_manager_for(self, *args, **kwargs):
+        if self._ssl_context is not None:
+            kwargs["ssl_context"] = self._ssl_context
+        return super().proxy_manager_for(*args, **kwargs)
+
+
+def _ssl_context(config: Dict) -> Optional[ssl.SSLContext]:
+    if "cert-crt" not in config:
+        return None
+    context = create_urllib3_context()
+    # the gateway is called with verify=False
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.load_cert_chain(config["cert-crt"], config.get("cert-key"))
+    return context
+
+
+def _create_session(config: Dict, pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = _MutualTLSAdapter(
+        _ssl_context(config),
+        pool_connections=1,
+        pool_maxsize=pool_size,
+        pool_block=True,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.verify = False
+    session.headers.update({
+        "BIK-OAPI-Key": config.get("BIK-OAPI-Key", ""),
+        "Content-Type": "application/json",
+        "Connection": "keep-alive",
+    })
+    return session
+
+
+def session(config: Dict, pool_size: int) -> requests.Session:
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = _create_session(config, pool_size)
+        return _session
+
+
+def timeout(config: Dict) -> Tuple[float, float]:
+    return config.get("connect_timeout", 5.0), config.get("read_timeout", 30.0)
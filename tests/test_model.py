@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+from src.model import (
+    IncrementalScorer, batch_coarse_means, batch_partial_utilities, coarse_criteria, coarse_groups, criteria_matrix,
+    default_thresholds, fine_criteria, fine_sources, partial_utilities, score, score_bounds, threshold_vector, transforms,
+    utility_bounds
+)
+
+
+def random_variants(rng, n, thresh):
+    # raw values below zero, inside and beyond every threshold
+    scale = {t.source: t.unit * (thresh[t.threshold] if t.threshold else 100) for t in transforms.values()}
+    return [{source: float(rng.uniform(-0.5, 2)) * s for source, s in scale.items()} for _ in range(n)]
+
+
+def thresholds(kind, rng):
+    if kind == "default":
+        return dict(default_thresholds)
+    if kind == "zero":
+        return {name: 0 for name in default_thresholds}
+    return {name: float(rng.uniform(0, 2)) * value for name, value in default_thresholds.items()}
+
+
+@pytest.mark.parametrize("kind", ["default", "zero", "random"])
+def test_batch_partial_utilities_match_partial_utilities(kind):
+    rng = np.random.default_rng(0)
+    thresh = thresholds(kind, rng)
+    variants = random_variants(rng, 500, thresh)
+    fine = batch_partial_utilities(criteria_matrix(variants), threshold_vector(thresh))
+    expected = np.array([[partial_utilities(thresh, v)[f] for f in fine_criteria] for v in variants])
+    np.testing.assert_allclose(fine, expected, rtol=0, atol=1e-12)
+
+
+@pytest.mark.parametrize("kind", ["default", "zero", "random"])
+def test_score_matches_weighted_group_means(kind):
+    rng = np.random.default_rng(1)
+    thresh = thresholds(kind, rng)
+    weights = dict(zip(coarse_groups, rng.uniform(0, 1, len(coarse_groups))))
+    variants = random_variants(rng, 500, thresh)
+    _, _, scores = score(variants, thresh, weights)
+    total = sum(weights.values())
+    expected = []
+    for v in variants:
+        u = partial_utilities(thresh, v)
+        expected.append(sum(weights[g] / total * np.mean([u[f] for f in coarse_criteria[g]]) for g in coarse_groups))
+    np.testing.assert_allclose(scores, expected, rtol=0, atol=1e-12)
+
+
+def test_missing_criterion_only_blanks_its_group():
+    variant = random_variants(np.random.default_rng(2), 1, default_thresholds)[0]
+    del variant["cr3"]
+    fine = batch_partial_utilities(criteria_matrix([variant]), threshold_vector(default_thresholds))
+    means = batch_coarse_means(fine)[0]
+    assert np.isnan(means[coarse_groups.index("Safety")])
+    assert not np.isnan(np.delete(means, coarse_groups.index("Safety"))).any()
+
+
+@pytest.mark.parametrize("seed", range(3))
+def test_incremental_scorer_matches_score(seed):
+    # random threshold (also 0 and NaN), weight and variant set changes; some
+    # variants miss criteria
+    rng = np.random.default_rng(seed)
+    thresh = dict(default_thresholds)
+    weights = dict(zip(coarse_groups, rng.uniform(0, 1, len(coarse_groups))))
+    ids = iter(range(10 ** 9))
+
+    def new_variant():
+        v = random_variants(rng, 1, default_thresholds)[0]
+        for source in rng.choice(fine_sources, int(rng.integers(0, 3)), replace=False):
+            v.pop(source, None)
+        return next(ids), v
+
+    variants = [new_variant() for _ in range(20)]
+    scorer = IncrementalScorer()
+    for _ in range(200):
+        change = rng.integers(5)
+        if change == 0:
+            name = str(rng.choice(list(thresh)))
+            thresh[name] = [0, np.nan, float(rng.uniform(0, 2)) * default_thresholds[name]][rng.integers(3)]
+        elif change == 1:
+            weights[str(rng.choice(coarse_groups))] = [0, float(rng.uniform(0, 1))][rng.integers(2)]
+        elif change == 2:
+            variants += [new_variant() for _ in range(rng.integers(1, 4))]
+        elif change == 3 and len(variants) > 1:
+            variants.pop(rng.integers(len(variants)))
+        else:
+            rng.shuffle(variants)
+            variants[0] = new_variant()
+        if not any(weights.values()):
+            weights[coarse_groups[0]] = 1.0
+        keys, values = [k for k, _ in variants], [v for _, v in variants]
+        for got, expected in zip(scorer.score(keys, values, thresh, weights), score(values, thresh, weights)):
+            np.testing.assert_allclose(got, expected, rtol=0, atol=1e-12)
+        expected = batch_coarse_means(batch_partial_utilities(criteria_matrix(values), threshold_vector(thresh)))
+        np.testing.assert_allclose(scorer.means(), expected, rtol=0, atol=1e-12)
+
+
+def test_linear_scores_are_not_clipped():
+    variant = random_variants(np.random.default_rng(3), 1, default_thresholds)[0]
+    variant["cr3"] = 130
+    assert partial_utilities(default_thresholds, variant)["cr3"] == pytest.approx(1.3)
+
+
+@pytest.mark.parametrize("kind", ["default", "zero", "random"])
+def test_bounds_hold_with_the_data(kind):
+    # the random variants go past every nominal range, bounds from the same
+    # data still hold for any subset of their criteria
+    rng = np.random.default_rng(4)
+    thresh = thresholds(kind, rng)
+    weights = dict(zip(coarse_groups, rng.uniform(0, 1, len(coarse_groups))))
+    X = criteria_matrix(random_variants(rng, 200, thresh))
+    lo, hi = utility_bounds(thresh, X)
+    fine = batch_partial_utilities(X, threshold_vector(thresh))
+    assert (fine >= lo).all() and (fine <= hi).all()
+
+    _, _, scores = score([dict(zip(fine_sources, row)) for row in X], thresh, weights)
+    partial = np.where(rng.uniform(size=fine.shape) < 0.5, np.nan, fine)
+    lower, upper = score_bounds(partial, (lo, hi), weights)
+    assert (lower <= scores + 1e-12).all() and (scores <= upper + 1e-12).all()
@@ -0,0 +1,34 @@
+import csv
+
+from src import rank
+
+
+def test_resume_drops_a_partial_last_row(tmp_path, monkeypatch):
+    addresses = tmp_path / "addresses.csv"
+    with open(addresses, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["City", "Street", "Building No.", "Postal Code"])
+        for i in range(5):
+            writer.writerow(["Kraków", "Długa", str(i), "31-146"])
+    fetched = []
+
+    def details(row, only):
+        fetched.append(row["Building No."])
+        return {"number": row["Building No."]}
+    monkeypatch.setattr(rank, "_try_details", details)
+    monkeypatch.setattr(rank, "score", lambda variants, thresh, weights: (None, None, [float(v["number"]) for v in variants]))
+
+    # killed while writing the third row
+    out = str(tmp_path / "ranking.csv")
+    with open(out + ".scores.csv", "w", newline="") as f:
+        f.write("City,Street,Building No.,Postal Code,MatchScore\r\n")
+        f.write("Kraków,Długa,0,31-146,0.0\r\n")
+        f.write("Kraków,Długa,1,31-146,1.0\r\n")
+        f.write("Kraków,Długa,2,31-1")
+
+    rank.rank(str(addresses), "Student", out, k=3)
+    assert fetched == ["2", "3", "4"]
+    with open(out + ".scores.csv", newline="") as f:
+        assert [row["MatchScore"] for row in csv.DictReader(f)] == ["0.0", "1.0", "2.0", "3.0", "4.0"]
+    with open(out, newline="") as f:
+        assert [row["Building No."] for row in csv.DictReader(f)] == ["4", "3", "2"]
@@ -0,0 +1,99 @@
+import pytest
+
+from src import cache, req
+from src.resilience import GatewayError
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # a fresh cache and default config, no circuit or rate limit state
+    store = cache.Cache(str(tmp_path / "responses.sqlite"))
+    monkeypatch.setattr(req, "_config", {"cache_dir": str(tmp_path)})
+    monkeypatch.setattr(req, "_cache", store)
+    monkeypatch.setattr(req, "_breakers", {})
+    monkeypatch.setattr(req, "_rate_limiters", {})
+    monkeypatch.setattr(req, "throttle", None)
+    return store
+
+
+def test_raising_hook_settles_the_half_open_trial(store, monkeypatch):
+    endpoint = "bik-api-5/geoscore-adres"
+    breaker = req._breaker(endpoint)
+    for _ in range(breaker.failures):
+        breaker.record(False)
+    breaker._opened -= breaker.reset + 1
+
+    def hook(endpoint):
+        raise RuntimeError("hook")
+    monkeypatch.setattr(req, "throttle", hook)
+    with pytest.raises(RuntimeError):
+        req._post(endpoint, "{}", "http://gateway.invalid/")
+    # recorded as a failed trial: once the reset passes again, so can a new one
+    assert breaker.open
+    breaker._opened -= breaker.reset + 1
+    assert breaker.allow()
+
+
+def expire(store, endpoint, payload, age=30 * 24 * 3600):
+    # backdate an entry in both tiers
+    k = cache.key(endpoint, payload)
+    value, created = store.entry(endpoint, payload, count=False)
+    store.l1.put(k, (value, created - age))
+    store.l2._db.execute("UPDATE responses SET created = ? WHERE key = ?", (created - age, k))
+    store.l2._db.commit()
+
+
+def test_fetch_rechecks_what_other_replicas_stored(store, tmp_path, monkeypatch):
+    # two replicas share the sqlite file; ours still has the expired entry
+    # in L1 when the other one has already refreshed it
+    other = cache.Cache(str(tmp_path / "responses.sqlite"))
+    posts = []
+    monkeypatch.setattr(req, "_post", lambda endpoint, payload, base: posts.append(payload) or {"n": len(posts)})
+    endpoint, payload = "bik-api-3/bezpieczenstwo-adres", {"address": 1}
+
+    assert req._fetch(endpoint, payload, "http://gateway.invalid/") == {"n": 1}
+    expire(store, endpoint, payload)
+    other.put(endpoint, payload, {"n": "other"})
+    assert req._fetch(endpoint, payload, "http://gateway.invalid/", fresh=True) == {"n": "other"}
+    assert len(posts) == 1
+    # and L1 serves the refreshed entry from now on
+    assert store.l1.get(cache.key(endpoint, payload))[0] == {"n": "other"}
+
+    expire(store, endpoint, payload)
+    assert req._fetch(endpoint, payload, "http://gateway.invalid/", fresh=True) == {"n": 2}
+    assert len(posts) == 2
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+
+    def json(self):
+        return {}
+
+
+def answer(monkeypatch, *statuses):
+    # the gateway answers these statuses in turn
+    statuses = iter(statuses)
+
+    class Session:
+        def post(self, url, data, timeout):
+            return FakeResponse(next(statuses))
+    monkeypatch.setattr(req.transport, "session", lambda config, pool_size: Session())
+
+
+def test_no_rate_limit_until_the_gateway_throttles(store, monkeypatch):
+    endpoint = "bik-api-4/punkty-zainteresowania-adres"
+    answer(monkeypatch, 200, 429)
+    req._post(endpoint, "{}", "http://gateway.invalid/")
+    assert req._rate_limiter(endpoint) is None
+    with pytest.raises(GatewayError):
+        req._post(endpoint, "{}", "http://gateway.invalid/")
+    assert req._rate_limiter(endpoint).rate == req._default_rate_limit / 2
+
+
+def test_configured_rate_limit(store, monkeypatch):
+    monkeypatch.setitem(req._config, "rate_limits", {"bik-api-4": 4})
+    assert req._rate_limiter("bik-api-4/liczba-poi-adres").rate == 4
+    assert req._rate_limiter("bik-api-5/geoscore-adres") is None
@@ -0,0 +1,74 @@
+import pytest
+
+from src import resilience
+from src.resilience import CircuitBreaker, GatewayError, backoff
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience.time, "monotonic", lambda: now[0])
+    return now
+
+
+def open_breaker(clock) -> CircuitBreaker:
+    breaker = CircuitBreaker(failures=3, reset=30)
+    for _ in range(3):
+        assert breaker.allow()
+        breaker.record(False)
+    assert breaker.open
+    return breaker
+
+
+def test_opens_after_failures_in_a_row(clock):
+    breaker = CircuitBreaker(failures=3, reset=30)
+    for _ in range(2):
+        breaker.record(False)
+    breaker.record(True)
+    breaker.record(False)
+    assert not breaker.open
+    open_breaker(clock)
+
+
+def test_half_open_admits_a_single_trial(clock):
+    breaker = open_breaker(clock)
+    assert not breaker.allow()
+    clock[0] += 31
+    assert breaker.allow()
+    # the trial is out, everyone else still fails fast
+    assert not breaker.allow()
+    assert not breaker.allow()
+
+
+def test_successful_trial_closes(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 31
+    assert breaker.allow()
+    breaker.record(True)
+    assert not breaker.open
+    assert breaker.allow() and breaker.allow()
+
+
+def test_failed_trial_reopens_for_another_reset(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 31
+    assert breaker.allow()
+    breaker.record(False)
+    assert breaker.open
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 2
+    assert breaker.allow()
+
+
+def test_retryable_statuses():
+    assert GatewayError("e", None).retryable
+    assert GatewayError("e", 429).retryable
+    assert GatewayError("e", 503).retryable
+    assert not GatewayError("e", 400).retryable
+
+
+def test_backoff_honors_retry_after():
+    assert backoff(0, retry_after="7") == 7
+    assert backoff(0, retry_after="1000", cap=30) == 30
+    assert 0 <= backoff(3, base=0.5, retry_after="Wed, 21 Oct 2015 07:28:00 GMT") <= 4